@@ -0,0 +1,164 @@
+"""Admission control for write endpoints.
+
+Every write (non-GET) request to a route decorated with
+``@admission.limit_writes`` must pass two checks before it runs:
+
+- a per-user token bucket (RATE_PER_MINUTE with up to BURST saved up), and
+- a global cap on concurrent database writes (MAX_INFLIGHT_WRITES), with a
+  short wait of QUEUE_TIMEOUT_MS for a slot to free up.
+
+Requests that fail either check get an immediate 429 with Retry-After
+instead of queueing behind SQLite's write lock, so reads stay responsive
+during write storms. State lives in-process by default. Set
+SHARED_STATE_FILE to a local SQLite file so that several worker processes
+on one host share the buckets and the write cap.
+"""
+import math
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from functools import wraps
+
+from flask import request, session
+
+# Slots held longer than this are assumed to belong to a crashed worker
+STALE_SLOT_SECONDS = 60
+POLL_SECONDS = 0.01
+
+
+class MemoryBackend:
+    def __init__(self, max_inflight):
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._slots = threading.BoundedSemaphore(max_inflight)
+
+    def take_token(self, key, rate, burst):
+        """Take one token; returns seconds to wait if the bucket is empty, else 0"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                return 0
+            self._buckets[key] = (tokens, now)
+            return (1 - tokens) / rate
+
+    def acquire_slot(self, timeout):
+        return True if self._slots.acquire(timeout=timeout) else None
+
+    def release_slot(self, slot):
+        self._slots.release()
+
+
+class SqliteBackend:
+    """Buckets and write slots shared between processes through a SQLite file"""
+
+    def __init__(self, path, max_inflight):
+        self.path = path
+        self.max_inflight = max_inflight
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS buckets '
+                         '(key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)')
+            conn.execute('CREATE TABLE IF NOT EXISTS slots '
+                         '(id TEXT PRIMARY KEY, pid INTEGER NOT NULL, started REAL NOT NULL)')
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+
+    def take_token(self, key, rate, burst):
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            row = conn.execute('SELECT tokens, updated FROM buckets WHERE key = ?', (key,)).fetchone()
+            tokens, updated = row if row else (burst, now)
+            tokens = min(burst, tokens + max(0, now - updated) * rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / rate
+            if not wait:
+                tokens -= 1
+            conn.execute('INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)',
+                         (key, tokens, now))
+            conn.execute('COMMIT')
+            return wait
+        finally:
+            conn.close()
+
+    def acquire_slot(self, timeout):
+        deadline = time.monotonic() + timeout
+        conn = self._connect()
+        try:
+            while True:
+                now = time.time()
+                conn.execute('BEGIN IMMEDIATE')
+                conn.execute('DELETE FROM slots WHERE started < ?', (now - STALE_SLOT_SECONDS,))
+                (in_use,) = conn.execute('SELECT COUNT(*) FROM slots').fetchone()
+                if in_use < self.max_inflight:
+                    slot = uuid.uuid4().hex
+                    conn.execute('INSERT INTO slots (id, pid, started) VALUES (?, ?, ?)',
+                                 (slot, os.getpid(), now))
+                    conn.execute('COMMIT')
+                    return slot
+                conn.execute('COMMIT')
+                if time.monotonic() >= deadline:
+                    return None
+                time.sleep(POLL_SECONDS)
+        finally:
+            conn.close()
+
+    def release_slot(self, slot):
+        conn = self._connect()
+        try:
+            conn.execute('DELETE FROM slots WHERE id = ?', (slot,))
+        finally:
+            conn.close()
+
+
+class AdmissionController:
+    def __init__(self, config):
+        self.enabled = config.getboolean('Admission', 'ENABLED', fallback=True)
+        self.rate = config.getfloat('Admission', 'RATE_PER_MINUTE', fallback=30) / 60
+        self.burst = config.getfloat('Admission', 'BURST', fallback=10)
+        self.queue_timeout = config.getfloat('Admission', 'QUEUE_TIMEOUT_MS', fallback=250) / 1000
+        max_inflight = config.getint('Admission', 'MAX_INFLIGHT_WRITES', fallback=4)
+        shared_state_file = config.get('Admission', 'SHARED_STATE_FILE', fallback='')
+        if shared_state_file:
+            self.backend = SqliteBackend(shared_state_file, max_inflight)
+        else:
+            self.backend = MemoryBackend(max_inflight)
+
+    def client_key(self):
+        discord_user = session.get('discord_user')
+        if discord_user:
+            return f"user:{discord_user['id']}"
+        return f'ip:{request.remote_addr}'
+
+    def limit_writes(self, view):
+        """Apply the rate limit and write cap to a view's non-GET requests"""
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if not self.enabled or request.method in ('GET', 'HEAD', 'OPTIONS'):
+                return view(*args, **kwargs)
+
+            wait = self.backend.take_token(self.client_key(), self.rate, self.burst)
+            if wait:
+                return too_many_requests(wait, 'You are making changes too quickly.')
+
+            slot = self.backend.acquire_slot(self.queue_timeout)
+            if slot is None:
+                return too_many_requests(1, 'The server is busy saving other changes.')
+            try:
+                return view(*args, **kwargs)
+            finally:
+                self.backend.release_slot(slot)
+        return wrapper
+
+
+def too_many_requests(retry_after, message):
+    seconds = max(1, math.ceil(retry_after))
+    return (f'{message} Please try again in {seconds} seconds.', 429,
+            {'Retry-After': str(seconds), 'Content-Type': 'text/plain; charset=utf-8'})
@@ -0,0 +1,187 @@
+"""Ballot similarity: closest rivals and duplicate ballots.
+
+A pool's ballots are encoded as an integer matrix with one row per user
+and one column per category, holding the picked nominee id (0 = no pick).
+Two ballots agree on a category when both picked the same nominee. Their
+similarity is the share of categories both answered where they agree
+(one minus the Hamming distance over the shared categories).
+
+Agreement counts for every pair come from matrix products of a one-hot
+encoding, one block of rows at a time. This keeps memory at
+block_size x users rather than users squared, and never loops over pairs
+in Python.
+"""
+import random
+import time
+from collections import namedtuple
+
+import numpy as np
+
+BallotMatrix = namedtuple('BallotMatrix', ['user_ids', 'category_ids', 'picks'])
+Rival = namedtuple('Rival', ['user_id', 'rival_id', 'matches', 'compared', 'similarity'])
+
+DEFAULT_BLOCK_SIZE = 512
+
+
+def build_matrix(rows):
+    """Encode (user_id, category_id, nominee_id) rows as a BallotMatrix"""
+    data = np.array(list(rows), dtype=np.int64).reshape(-1, 3)
+    user_ids, user_index = np.unique(data[:, 0], return_inverse=True)
+    category_ids, category_index = np.unique(data[:, 1], return_inverse=True)
+    picks = np.zeros((len(user_ids), len(category_ids)), dtype=np.int64)
+    picks[user_index, category_index] = data[:, 2]
+    return BallotMatrix(user_ids, category_ids, picks)
+
+
+def _encode(picks):
+    """One-hot columns per (category, nominee) pair plus an answered mask, as float32"""
+    answered = picks != 0
+    rows, columns = np.nonzero(answered)
+    keys = columns * (int(picks.max(initial=0)) + 1) + picks[rows, columns]
+    _, pair_index = np.unique(keys, return_inverse=True)
+    one_hot = np.zeros((picks.shape[0], int(pair_index.max(initial=-1)) + 1), dtype=np.float32)
+    one_hot[rows, pair_index] = 1
+    return one_hot, answered.astype(np.float32)
+
+
+def similarity_blocks(matrix, block_size=DEFAULT_BLOCK_SIZE):
+    """Yield (start, matches, compared) for consecutive blocks of rows.
+
+    matches[i, j] is how many categories ballot start+i and ballot j picked
+    the same nominee in; compared[i, j] how many both answered.
+    """
+    one_hot, answered = _encode(matrix.picks)
+    for start in range(0, len(matrix.user_ids), block_size):
+        stop = start + block_size
+        matches = one_hot[start:stop] @ one_hot.T
+        compared = answered[start:stop] @ answered.T
+        yield start, matches, compared
+
+
+def _similarity(matches, compared):
+    return np.divide(matches, compared, out=np.zeros_like(matches), where=compared > 0)
+
+
+def nearest_rivals(matrix, block_size=DEFAULT_BLOCK_SIZE):
+    """The most similar other ballot for every user (ties go to more matches)"""
+    n = len(matrix.user_ids)
+    if n < 2:
+        return []
+
+    rivals = []
+    for start, matches, compared in similarity_blocks(matrix, block_size):
+        rows = np.arange(matches.shape[0])
+        similarity = _similarity(matches, compared)
+        similarity[rows, rows + start] = -1
+        # Among the most similar ballots, take the one with the most agreements
+        best_similarity = similarity.max(axis=1, keepdims=True)
+        best = np.where(similarity == best_similarity, matches, -1).argmax(axis=1)
+        for row, column in enumerate(best):
+            rivals.append(Rival(
+                int(matrix.user_ids[start + row]),
+                int(matrix.user_ids[column]),
+                int(matches[row, column]),
+                int(compared[row, column]),
+                float(similarity[row, column]),
+            ))
+    return rivals
+
+
+def _compress(labels):
+    """Point every label straight at its root (labels only ever point lower)"""
+    while True:
+        parents = labels[labels]
+        if np.array_equal(parents, labels):
+            return labels
+        labels = parents
+
+
+def _merge(labels, a, b):
+    """Join the components of every pair (a[k], b[k]); labels must be compressed"""
+    while True:
+        root_a, root_b = labels[a], labels[b]
+        differ = root_a != root_b
+        if not differ.any():
+            return labels
+        a, b = a[differ], b[differ]
+        # Hook each larger root onto the smallest root it is paired with
+        np.minimum.at(labels, np.maximum(root_a, root_b)[differ], np.minimum(root_a, root_b)[differ])
+        labels = _compress(labels)
+
+
+def duplicate_clusters(matrix, threshold=1.0, min_compared=1, block_size=DEFAULT_BLOCK_SIZE):
+    """Groups of user ids whose ballots are at least `threshold` similar.
+
+    Only pairs that share at least min_compared answered categories count,
+    so two nearly empty ballots aren't flagged. Pairs are joined
+    transitively by label propagation over each block's similar pairs;
+    clusters are returned largest first.
+    """
+    n = len(matrix.user_ids)
+    labels = np.arange(n)
+    for start, matches, compared in similarity_blocks(matrix, block_size):
+        similar = (_similarity(matches, compared) >= threshold - 1e-9) & (compared >= min_compared)
+        # Each pair once: only look right of the diagonal
+        similar &= np.arange(n)[None, :] > (np.arange(similar.shape[0]) + start)[:, None]
+        rows, columns = np.nonzero(similar)
+        labels = _merge(labels, rows + start, columns)
+
+    order = np.argsort(labels, kind='stable')
+    _, first, sizes = np.unique(labels[order], return_index=True, return_counts=True)
+    clusters = [matrix.user_ids[order[i:i + size]].tolist()
+                for i, size in zip(first, sizes) if size > 1]
+    return sorted(clusters, key=lambda members: (-len(members), members[0]))
+
+
+def _naive_nearest(picks, user_count):
+    """Pure Python pairwise comparison, for the benchmark"""
+    ballots = [dict(enumerate(row)) for row in picks[:user_count].tolist()]
+    for i, ballot in enumerate(ballots):
+        best = -1
+        for j, other in enumerate(ballots):
+            if i == j:
+                continue
+            matches = compared = 0
+            for category, nominee in ballot.items():
+                theirs = other[category]
+                if nominee and theirs:
+                    compared += 1
+                    matches += nominee == theirs
+            best = max(best, matches / compared if compared else 0)
+
+
+def benchmark(ballots=5000, categories=23, nominees=5, duplicates=50, naive_sample=300, seed=0):
+    """Time the analysis on synthetic ballots; returns ({step: seconds}, clusters found).
+
+    The pure Python pairwise loop is timed on naive_sample ballots and
+    scaled up (it is quadratic) to estimate its cost at full size.
+    """
+    rng = random.Random(seed)
+    rows = []
+    for user_id in range(1, ballots + 1):
+        source = user_id - duplicates if duplicates < user_id <= 2 * duplicates else user_id
+        pick_rng = random.Random(source * 7919 + seed)
+        for category_id in range(1, categories + 1):
+            nominee_id = category_id * 100 + pick_rng.randrange(nominees)
+            if rng.random() < 0.97:  # leave a few categories blank
+                rows.append((user_id, category_id, nominee_id))
+
+    timings = {}
+    start = time.perf_counter()
+    matrix = build_matrix(rows)
+    timings['build matrix'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    nearest_rivals(matrix)
+    timings['nearest rivals'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    clusters = duplicate_clusters(matrix, threshold=0.95, min_compared=categories // 2)
+    timings['duplicate clusters'] = time.perf_counter() - start
+
+    sample = min(naive_sample, ballots)
+    start = time.perf_counter()
+    _naive_nearest(matrix.picks, sample)
+    elapsed = time.perf_counter() - start
+    timings[f'pure Python loop (estimated from {sample})'] = elapsed * (ballots / sample) ** 2
+    return timings, len(clusters)
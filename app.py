@@ -1,22 +1,45 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session
+from flask import (Flask, Response, g, has_request_context, jsonify, render_template, request, redirect,
+                   url_for, flash, session)
 from flask_sqlalchemy import SQLAlchemy
 from requests_oauthlib import OAuth2Session
 import os
 import configparser
-from datetime import timedelta
+from collections import namedtuple
+from datetime import datetime, timedelta
 from flask_migrate import Migrate
+from assets import init_assets
+from routing import RoutingSession, init_routing, primary_only, read_from_replica
+from notifications import WebhookDispatcher
+from profiling import MODES as PROFILER_MODES, RequestProfiler
+from admission import AdmissionController
+from analysis import build_matrix, duplicate_clusters, nearest_rivals
+from api import ApiTokens, ndjson_response, requested_fields
+from sessions import init_sessions, is_sessionless_request, regenerate_session
+from templating import init_templates, warmup_templates
+from tenancy import (GUILD_KEY, GUILDS_KEY, create_tenant_schemas, current_guild,
+                     init_tenancy, one_guild_per_database, select_guild, use_guild)
 
 # Load config
 config = configparser.ConfigParser()
 config.read('settings.config')
 
 app = Flask(__name__)
+template_cache_dir = init_templates(app, config)
 app.config['SECRET_KEY'] = config['Flask']['SECRET_KEY']
 app.config['SQLALCHEMY_DATABASE_URI'] = config['Flask']['SQLALCHEMY_DATABASE_URI']
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.permanent_session_lifetime = timedelta(days=7)
+session_store = init_sessions(app, config)
+profiler = RequestProfiler()
+profiler.init_app(app)
+init_routing(app, config)
+init_tenancy(app, config)
 
-db = SQLAlchemy(app)
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})
 migrate = Migrate(app, db)
+init_assets(app, config)
+admission = AdmissionController(config)
+api_tokens = ApiTokens(config)
 
 # Load Discord settings from config
 DISCORD_CLIENT_ID = config['Discord']['CLIENT_ID']
@@ -37,10 +60,14 @@ class User(db.Model):
         db.UniqueConstraint('discord_id', name='unique_discord_id'),
     )
 
+# Season assumed for catalog rows and pools created before seasons existed
+DEFAULT_SEASON = config.getint('Data', 'SEASON', fallback=datetime.now().year)
+
 class Category(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     show_movie = db.Column(db.Boolean, default=False)
+    season = db.Column(db.Integer, nullable=False, index=True, server_default=str(DEFAULT_SEASON))
 
 class Nominee(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -55,8 +82,11 @@ class Pool(db.Model):
     name = db.Column(db.String(100), nullable=False)
     is_active = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, server_default=db.func.now())
+    webhook_url = db.Column(db.String(500))  # Discord webhook for standings updates
+    season = db.Column(db.Integer, nullable=False, server_default=str(DEFAULT_SEASON))
+    guild_id = db.Column(db.String(20), index=True)  # NULL for pools created before tenancy
     __table_args__ = (
-        db.UniqueConstraint('name', name='unique_pool_name'),
+        db.UniqueConstraint('guild_id', 'name', name='unique_guild_pool_name'),
     )
 
 class Prediction(db.Model):
@@ -64,7 +94,7 @@ class Prediction(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id', name='fk_prediction_user'), nullable=False)
     nominee_id = db.Column(db.Integer, db.ForeignKey('nominee.id', name='fk_prediction_nominee'), nullable=False)
     category_id = db.Column(db.Integer, db.ForeignKey('category.id', name='fk_prediction_category'), nullable=False)
-    pool_id = db.Column(db.Integer, db.ForeignKey('pool.id', name='fk_prediction_pool'), nullable=False)
+    pool_id = db.Column(db.Integer, db.ForeignKey('pool.id', name='fk_prediction_pool'), nullable=False, index=True)
     created_at = db.Column(db.DateTime, server_default=db.func.now())
     updated_at = db.Column(db.DateTime, server_default=db.func.now(), onupdate=db.func.now())
     
@@ -77,6 +107,637 @@ class Prediction(db.Model):
         db.UniqueConstraint('user_id', 'category_id', 'pool_id', name='unique_user_category_pool_prediction'),
     )
 
+class Ballot(db.Model):
+    """A user's whole ballot for a pool packed into a single row.
+
+    Only used when BALLOT_STORAGE = packed. picks maps category id (as a
+    string, since it is stored as JSON) to the chosen nominee id.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', name='fk_ballot_user'), nullable=False)
+    pool_id = db.Column(db.Integer, db.ForeignKey('pool.id', name='fk_ballot_pool'), nullable=False, index=True)
+    picks = db.Column(db.JSON, nullable=False, default=dict)
+    version = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, server_default=db.func.now())
+    updated_at = db.Column(db.DateTime, server_default=db.func.now(), onupdate=db.func.now())
+
+    user = db.relationship('User', backref=db.backref('ballots', lazy=True))
+    pool = db.relationship('Pool', backref=db.backref('ballots', lazy=True))
+
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'pool_id', name='unique_user_pool_ballot'),
+    )
+    # Concurrent saves of the same ballot fail instead of silently overwriting
+    __mapper_args__ = {'version_id_col': version}
+
+class WebhookOutbox(db.Model):
+    """A pending standings update for a pool's webhook.
+
+    There is at most one row per pool; revision is bumped whenever winners
+    change again before the update has been delivered.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    pool_id = db.Column(db.Integer, db.ForeignKey('pool.id', name='fk_webhook_outbox_pool'), nullable=False)
+    revision = db.Column(db.Integer, nullable=False, default=1)
+    due_at = db.Column(db.DateTime, nullable=False)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    last_error = db.Column(db.String(200))
+    created_at = db.Column(db.DateTime, server_default=db.func.now())
+
+    pool = db.relationship('Pool', backref=db.backref('pending_webhooks', lazy=True))
+
+    __table_args__ = (
+        db.UniqueConstraint('pool_id', name='unique_webhook_outbox_pool'),
+    )
+
+class SeasonStats(db.Model):
+    """Accuracy rollup for one user's ballot in one pool.
+
+    Kept up to date as ballots are saved and winners are set, so stats
+    pages read one row per pool instead of scanning every prediction.
+    hits maps category id (as a string) to 1/0 for categories that have a
+    winner; decided counts those picks and total counts every pick.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', name='fk_season_stats_user'), nullable=False)
+    pool_id = db.Column(db.Integer, db.ForeignKey('pool.id', name='fk_season_stats_pool'), nullable=False)
+    season = db.Column(db.Integer, nullable=False, index=True)
+    correct = db.Column(db.Integer, nullable=False, default=0)
+    decided = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Integer, nullable=False, default=0)
+    hits = db.Column(db.JSON, nullable=False, default=dict)
+    updated_at = db.Column(db.DateTime, server_default=db.func.now(), onupdate=db.func.now())
+
+    user = db.relationship('User', backref=db.backref('season_stats', lazy=True))
+    pool = db.relationship('Pool', backref=db.backref('season_stats', lazy=True))
+
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'pool_id', name='unique_user_pool_season_stats'),
+        db.Index('ix_season_stats_user_season', 'user_id', 'season'),
+    )
+
+# Ballot storage
+# A pick as returned by the ballot stores, before ids are resolved to models
+PickRow = namedtuple('PickRow', ['user_id', 'pool_id', 'category_id', 'nominee_id', 'updated_at'])
+# A pick with its models loaded, for templates
+BallotPick = namedtuple('BallotPick', ['user', 'pool', 'category', 'nominee', 'updated_at'])
+
+class RowBallotStore:
+    """Ballots stored as one Prediction row per category"""
+    name = 'rows'
+
+    def get(self, user_id, pool_id):
+        """Return {category_id: nominee_id} for a user's ballot in a pool"""
+        rows = (db.session.query(Prediction.category_id, Prediction.nominee_id)
+                .filter(Prediction.user_id == user_id, Prediction.pool_id == pool_id)
+                .all())
+        return {category_id: nominee_id for category_id, nominee_id in rows}
+
+    def save(self, user_id, pool_id, picks, updated_at=None):
+        """Merge {category_id: nominee_id} picks into a user's ballot.
+
+        updated_at overrides the modification time (used by imports).
+        """
+        existing = {
+            pred.category_id: pred
+            for pred in Prediction.query.filter_by(user_id=user_id, pool_id=pool_id).all()
+        }
+        for category_id, nominee_id in picks.items():
+            prediction = existing.get(category_id)
+            if prediction:
+                prediction.nominee_id = nominee_id
+            else:
+                prediction = Prediction(
+                    user_id=user_id,
+                    nominee_id=nominee_id,
+                    category_id=category_id,
+                    pool_id=pool_id
+                )
+                db.session.add(prediction)
+            if updated_at:
+                prediction.updated_at = updated_at
+
+    def delete(self, user_id, pool_id):
+        """Delete a user's whole ballot in a pool"""
+        return Prediction.query.filter_by(user_id=user_id, pool_id=pool_id).delete()
+
+    def picks(self, user_id=None, pool_id=None, pool_ids=None):
+        """Return PickRows, optionally filtered by user and/or pool.
+
+        pool_ids limits the pools to a list or a SELECT of pool ids.
+        """
+        query = db.session.query(Prediction.user_id, Prediction.pool_id, Prediction.category_id,
+                                 Prediction.nominee_id, Prediction.updated_at)
+        if user_id is not None:
+            query = query.filter(Prediction.user_id == user_id)
+        if pool_id is not None:
+            query = query.filter(Prediction.pool_id == pool_id)
+        if pool_ids is not None:
+            query = query.filter(Prediction.pool_id.in_(pool_ids))
+        return [PickRow(*row) for row in query.all()]
+
+    def stream(self, pool_id, batch_size=500):
+        """Yield (PickRow, username) for a pool, fetching batch_size rows at a time"""
+        query = (db.session.query(Prediction.user_id, Prediction.pool_id, Prediction.category_id,
+                                  Prediction.nominee_id, Prediction.updated_at, User.username)
+                 .join(User, Prediction.user_id == User.id)
+                 .filter(Prediction.pool_id == pool_id)
+                 .order_by(Prediction.user_id, Prediction.category_id)
+                 .yield_per(batch_size))
+        for *row, username in query:
+            yield PickRow(*row), username
+
+    def category_picks(self, category_id):
+        """Return (user_id, pool_id, nominee_id) for every pick in a category"""
+        return (db.session.query(Prediction.user_id, Prediction.pool_id, Prediction.nominee_id)
+                .filter(Prediction.category_id == category_id)
+                .all())
+
+    def remove_nominee(self, nominee_id, category_id):
+        """Drop every pick of a nominee; returns the (user_id, pool_id) ballots touched"""
+        ballots = set(db.session.query(Prediction.user_id, Prediction.pool_id)
+                      .filter(Prediction.nominee_id == nominee_id))
+        Prediction.query.filter_by(nominee_id=nominee_id).delete()
+        return ballots
+
+    def scores(self, pool_id):
+        """Return {user_id: correct picks} for everyone with a ballot in the pool"""
+        totals = {user_id: 0 for (user_id,) in (db.session.query(Prediction.user_id)
+                                                .filter(Prediction.pool_id == pool_id)
+                                                .distinct())}
+        correct = (db.session.query(Prediction.user_id, db.func.count(Prediction.id))
+                   .join(Nominee, Prediction.nominee_id == Nominee.id)
+                   .filter(Prediction.pool_id == pool_id, Nominee.winner == True)
+                   .group_by(Prediction.user_id)
+                   .all())
+        totals.update(correct)
+        return totals
+
+class PackedBallotStore:
+    """Ballots stored as one Ballot row per (user, pool)"""
+    name = 'packed'
+
+    def get(self, user_id, pool_id):
+        ballot = Ballot.query.filter_by(user_id=user_id, pool_id=pool_id).first()
+        if not ballot:
+            return {}
+        return {int(category_id): nominee_id for category_id, nominee_id in ballot.picks.items()}
+
+    def save(self, user_id, pool_id, picks, updated_at=None):
+        ballot = Ballot.query.filter_by(user_id=user_id, pool_id=pool_id).first()
+        if not ballot:
+            if not picks:
+                return  # Like the rows layout, an empty submission stores nothing
+            ballot = Ballot(user_id=user_id, pool_id=pool_id, picks={})
+            db.session.add(ballot)
+
+        merged = dict(ballot.picks)
+        merged.update({str(category_id): nominee_id for category_id, nominee_id in picks.items()})
+        if merged != ballot.picks:
+            # Assign a new dict so SQLAlchemy sees the JSON column change
+            ballot.picks = merged
+        if updated_at and (not ballot.updated_at or updated_at > ballot.updated_at):
+            ballot.updated_at = updated_at
+
+    def delete(self, user_id, pool_id):
+        return Ballot.query.filter_by(user_id=user_id, pool_id=pool_id).delete()
+
+    def picks(self, user_id=None, pool_id=None, pool_ids=None):
+        query = Ballot.query
+        if user_id is not None:
+            query = query.filter(Ballot.user_id == user_id)
+        if pool_id is not None:
+            query = query.filter(Ballot.pool_id == pool_id)
+        if pool_ids is not None:
+            query = query.filter(Ballot.pool_id.in_(pool_ids))
+        return [
+            PickRow(ballot.user_id, ballot.pool_id, int(category_id), nominee_id, ballot.updated_at)
+            for ballot in query.all()
+            for category_id, nominee_id in ballot.picks.items()
+        ]
+
+    def stream(self, pool_id, batch_size=500):
+        query = (db.session.query(Ballot, User.username)
+                 .join(User, Ballot.user_id == User.id)
+                 .filter(Ballot.pool_id == pool_id)
+                 .order_by(Ballot.user_id)
+                 .yield_per(batch_size))
+        for ballot, username in query:
+            for category_id, nominee_id in sorted((int(key), value) for key, value in ballot.picks.items()):
+                yield PickRow(ballot.user_id, ballot.pool_id, category_id, nominee_id,
+                              ballot.updated_at), username
+
+    def category_picks(self, category_id):
+        # Pull the one pick out of the JSON in SQL rather than decoding every ballot
+        nominee_id = Ballot.picks[str(category_id)].as_integer()
+        return (db.session.query(Ballot.user_id, Ballot.pool_id, nominee_id)
+                .filter(nominee_id.isnot(None))
+                .all())
+
+    def remove_nominee(self, nominee_id, category_id):
+        key = str(category_id)
+        ballots = set()
+        for ballot in Ballot.query.filter(Ballot.picks[key].as_integer() == nominee_id).all():
+            ballot.picks = {k: v for k, v in ballot.picks.items() if k != key}
+            ballots.add((ballot.user_id, ballot.pool_id))
+        return ballots
+
+    def scores(self, pool_id):
+        winners = {nominee_id for (nominee_id,) in
+                   db.session.query(Nominee.id).filter(Nominee.winner == True)}
+        return {
+            ballot.user_id: sum(1 for nominee_id in ballot.picks.values() if nominee_id in winners)
+            for ballot in Ballot.query.filter_by(pool_id=pool_id).all()
+        }
+
+BALLOT_STORES = {store.name: store for store in (RowBallotStore(), PackedBallotStore())}
+ballot_store = BALLOT_STORES[config.get('Data', 'BALLOT_STORAGE', fallback='rows')]
+
+def resolve_picks(rows):
+    """Load the users, pools, categories and nominees behind PickRows in bulk"""
+    def load(model, ids):
+        return {obj.id: obj for obj in model.query.filter(model.id.in_(ids)).all()} if ids else {}
+
+    users = load(User, {row.user_id for row in rows})
+    pools = load(Pool, {row.pool_id for row in rows})
+    categories = load(Category, {row.category_id for row in rows})
+    nominees = load(Nominee, {row.nominee_id for row in rows})
+    return [
+        BallotPick(users.get(row.user_id), pools.get(row.pool_id), categories.get(row.category_id),
+                   nominees.get(row.nominee_id), row.updated_at)
+        for row in rows
+        if row.user_id in users and row.pool_id in pools
+        and row.category_id in categories and row.nominee_id in nominees
+    ]
+
+def migrate_ballot_storage(target):
+    """Move every ballot into the target layout ('rows' or 'packed').
+
+    Runs in the caller's transaction; returns the number of ballots moved.
+    """
+    source = BALLOT_STORES['packed' if target == 'rows' else 'rows']
+
+    ballots = {}
+    updated = {}
+    for row in source.picks():
+        key = (row.user_id, row.pool_id)
+        ballots.setdefault(key, {})[row.category_id] = row.nominee_id
+        if row.updated_at and (key not in updated or row.updated_at > updated[key]):
+            updated[key] = row.updated_at
+
+    def timestamps(key):
+        # Leave updated_at to the server default when the source had none
+        return {'updated_at': updated[key]} if key in updated else {}
+
+    if target == 'packed':
+        Prediction.query.delete()
+        db.session.bulk_insert_mappings(Ballot, [
+            {'user_id': user_id, 'pool_id': pool_id, 'version': 1,
+             'picks': {str(category_id): nominee_id for category_id, nominee_id in picks.items()},
+             **timestamps((user_id, pool_id))}
+            for (user_id, pool_id), picks in ballots.items()
+        ])
+    else:
+        Ballot.query.delete()
+        db.session.bulk_insert_mappings(Prediction, [
+            {'user_id': user_id, 'pool_id': pool_id, 'category_id': category_id,
+             'nominee_id': nominee_id, **timestamps((user_id, pool_id))}
+            for (user_id, pool_id), picks in ballots.items()
+            for category_id, nominee_id in picks.items()
+        ])
+    return len(ballots)
+
+# Webhook notifications
+WEBHOOK_COALESCE_SECONDS = config.getfloat('Notifications', 'COALESCE_SECONDS', fallback=5)
+WEBHOOK_MAX_LINES = 25
+
+def queue_standings_updates(season):
+    """Queue a standings update for every pool of a season with a webhook.
+
+    Only pools of the winner's season are affected; earlier seasons' pools
+    would just get their unchanged standings posted again.
+
+    Runs in the caller's transaction so the update is only queued if the
+    winner change commits. Pools that already have an update pending get
+    their revision bumped instead of a second row.
+    """
+    hooked_pools = db.select(Pool.id).where(Pool.webhook_url != None, Pool.season == season)
+    (WebhookOutbox.query
+     .filter(WebhookOutbox.pool_id.in_(hooked_pools))
+     .update({WebhookOutbox.revision: WebhookOutbox.revision + 1}, synchronize_session=False))
+    due_at = datetime.utcnow() + timedelta(seconds=WEBHOOK_COALESCE_SECONDS)
+    db.session.execute(db.insert(WebhookOutbox).from_select(
+        ['pool_id', 'revision', 'due_at', 'attempts'],
+        db.select(Pool.id, db.literal(1), db.literal(due_at), db.literal(0))
+        .where(Pool.webhook_url != None, Pool.season == season,
+               Pool.id.not_in(db.select(WebhookOutbox.pool_id)))
+    ))
+
+def standings_payload(pool):
+    """Build the Discord webhook message with a pool's current standings"""
+    scores = ballot_store.scores(pool.id)
+    usernames = dict(db.session.query(User.id, User.username).filter(User.id.in_(scores)).all()) if scores else {}
+    announced = (Nominee.query.join(Category)
+                 .filter(Nominee.winner == True, Category.season == pool.season)
+                 .count())
+
+    ranked = sorted(scores.items(), key=lambda item: (-item[1], usernames.get(item[0], '')))
+    lines = [f"**{pool.name} standings** ({announced} winners announced)"]
+    for place, (user_id, correct) in enumerate(ranked[:WEBHOOK_MAX_LINES], start=1):
+        lines.append(f"{place}. {usernames.get(user_id, 'Unknown')} - {correct}")
+    if len(ranked) > WEBHOOK_MAX_LINES:
+        lines.append(f"...and {len(ranked) - WEBHOOK_MAX_LINES} more")
+    return {'content': '\n'.join(lines), 'allowed_mentions': {'parse': []}}
+
+webhook_dispatcher = WebhookDispatcher(app, db, WebhookOutbox, standings_payload, config)
+
+# Seasons and set-based pool operations
+def current_season():
+    """The newest season in the catalog"""
+    return db.session.query(db.func.max(Category.season)).scalar() or DEFAULT_SEASON
+
+def season_categories(season=None):
+    """Query for the categories of a season (the current one by default)"""
+    return Category.query.filter_by(season=season or current_season())
+
+def guild_filter():
+    """Criterion limiting Pool to the current guild.
+
+    Outside a guild only the CLI (manage_db without --guild) and API tokens
+    without a guild see every pool; other requests see none.
+    """
+    guild_id = current_guild()
+    if guild_id is None:
+        if has_request_context() and not g.get('api_client'):
+            return db.false()
+        return db.true()
+    return db.or_(Pool.guild_id == guild_id, Pool.guild_id.is_(None))
+
+def guild_pools():
+    """Query for the current guild's pools, including ones from before tenancy"""
+    return Pool.query.filter(guild_filter())
+
+def guild_pool_or_404(pool_id):
+    return guild_pools().filter(Pool.id == pool_id).first_or_404()
+
+def copy_pool(source_pool, new_name, copy_ballots=True):
+    """Create a pool like source_pool, optionally copying every ballot.
+
+    Ballots are copied with INSERT ... SELECT for both storage layouts, so
+    the number of statements does not depend on the pool size. Runs in the
+    caller's transaction; returns (new_pool, copied prediction rows,
+    copied packed ballots).
+    """
+    new_pool = Pool(name=new_name, season=source_pool.season, is_active=True,
+                    guild_id=source_pool.guild_id)
+    db.session.add(new_pool)
+    db.session.flush()
+    if not copy_ballots:
+        return new_pool, 0, 0
+
+    predictions = db.session.execute(db.insert(Prediction).from_select(
+        ['user_id', 'nominee_id', 'category_id', 'pool_id'],
+        db.select(Prediction.user_id, Prediction.nominee_id, Prediction.category_id, db.literal(new_pool.id))
+        .where(Prediction.pool_id == source_pool.id)
+    )).rowcount
+    ballots = db.session.execute(db.insert(Ballot).from_select(
+        ['user_id', 'pool_id', 'picks', 'version'],
+        db.select(Ballot.user_id, db.literal(new_pool.id), Ballot.picks, db.literal(1))
+        .where(Ballot.pool_id == source_pool.id)
+    )).rowcount
+    db.session.execute(db.insert(SeasonStats).from_select(
+        ['user_id', 'pool_id', 'season', 'correct', 'decided', 'total', 'hits'],
+        db.select(SeasonStats.user_id, db.literal(new_pool.id), SeasonStats.season, SeasonStats.correct,
+                  SeasonStats.decided, SeasonStats.total, SeasonStats.hits)
+        .where(SeasonStats.pool_id == source_pool.id)
+    ))
+    return new_pool, predictions, ballots
+
+def purge_pool_predictions(pool_ids):
+    """Delete every ballot in the given pools with one DELETE per table.
+
+    Runs in the caller's transaction; returns (prediction rows, packed ballots).
+    """
+    predictions = db.session.execute(
+        db.delete(Prediction).where(Prediction.pool_id.in_(pool_ids))).rowcount
+    ballots = db.session.execute(
+        db.delete(Ballot).where(Ballot.pool_id.in_(pool_ids))).rowcount
+    db.session.execute(db.delete(SeasonStats).where(SeasonStats.pool_id.in_(pool_ids)))
+    return predictions, ballots
+
+def start_new_season(new_season=None):
+    """Start a new season: copy the category list and close last season's pools.
+
+    Nominees change every year, so only categories are carried over; import
+    the new nominees afterwards. Runs in the caller's transaction; returns
+    (new season, categories copied, pools deactivated).
+    """
+    old_season = current_season()
+    new_season = new_season or old_season + 1
+    if new_season <= old_season:
+        raise ValueError(f'Season {new_season} is not after the current season {old_season}')
+
+    categories = db.session.execute(db.insert(Category).from_select(
+        ['name', 'show_movie', 'season'],
+        db.select(Category.name, Category.show_movie, db.literal(new_season))
+        .where(Category.season == old_season)
+    )).rowcount
+    pools = db.session.execute(
+        db.update(Pool).where(Pool.season <= old_season, Pool.is_active == True).values(is_active=False)
+    ).rowcount
+    return new_season, categories, pools
+
+# Accuracy rollups
+def season_winners(season):
+    """Return {category_id: {winning nominee ids}} for a season's decided categories"""
+    winners = {}
+    for category_id, nominee_id in (db.session.query(Nominee.category_id, Nominee.id)
+                                    .join(Category)
+                                    .filter(Category.season == season, Nominee.winner == True)):
+        winners.setdefault(category_id, set()).add(nominee_id)
+    return winners
+
+def apply_hits(stats):
+    stats.correct = sum(stats.hits.values())
+    stats.decided = len(stats.hits)
+
+def refresh_ballot_rollup(user_id, pool, winners=None):
+    """Recompute the rollup row for one ballot (deleting it if the ballot is gone)"""
+    picks = ballot_store.get(user_id, pool.id)
+    stats = SeasonStats.query.filter_by(user_id=user_id, pool_id=pool.id).first()
+    if not picks:
+        if stats:
+            db.session.delete(stats)
+        return None
+
+    if winners is None:
+        winners = season_winners(pool.season)
+    if not stats:
+        stats = SeasonStats(user_id=user_id, pool_id=pool.id)
+        db.session.add(stats)
+    stats.season = pool.season
+    stats.total = len(picks)
+    stats.hits = {str(category_id): int(nominee_id in winners[category_id])
+                  for category_id, nominee_id in picks.items() if category_id in winners}
+    apply_hits(stats)
+    return stats
+
+def refresh_category_rollups(category):
+    """Update every rollup's hit flag for one category after its winner changed"""
+    db.session.flush()
+    winners = {nominee_id for (nominee_id,) in
+               db.session.query(Nominee.id).filter_by(category_id=category.id, winner=True)}
+    key = str(category.id)
+    picks = ballot_store.category_picks(category.id)
+    # Only the rollups of ballots with a pick here, a few hundred pairs per query
+    pairs = sorted({(user_id, pool_id) for user_id, pool_id, _ in picks})
+    existing = {}
+    for start in range(0, len(pairs), 500):
+        for stats in SeasonStats.query.filter(
+                db.tuple_(SeasonStats.user_id, SeasonStats.pool_id).in_(pairs[start:start + 500])):
+            existing[(stats.user_id, stats.pool_id)] = stats
+    pools = {}
+    for user_id, pool_id, nominee_id in picks:
+        stats = existing.get((user_id, pool_id))
+        if stats is None:
+            # No rollup yet for this ballot; build the whole row
+            pool = pools.get(pool_id) or pools.setdefault(pool_id, db.session.get(Pool, pool_id))
+            refresh_ballot_rollup(user_id, pool)
+            continue
+        hits = dict(stats.hits)
+        if winners:
+            hits[key] = int(nominee_id in winners)
+        else:
+            hits.pop(key, None)
+        if hits != stats.hits:
+            stats.hits = hits
+            apply_hits(stats)
+
+def backfill_rollups(season=None):
+    """Rebuild rollups from scratch for one season (or all); returns rows written"""
+    query = Pool.query if season is None else Pool.query.filter_by(season=season)
+    pools = {pool.id: pool for pool in query.all()}
+    if not pools:
+        return 0
+    SeasonStats.query.filter(SeasonStats.pool_id.in_(pools)).delete(synchronize_session=False)
+
+    winners_by_season = {}
+    ballots = {}
+    for row in ballot_store.picks(pool_ids=list(pools)):
+        ballots.setdefault((row.user_id, row.pool_id), {})[row.category_id] = row.nominee_id
+
+    rows = []
+    for (user_id, pool_id), picks in ballots.items():
+        season = pools[pool_id].season
+        if season not in winners_by_season:
+            winners_by_season[season] = season_winners(season)
+        winners = winners_by_season[season]
+        hits = {str(category_id): int(nominee_id in winners[category_id])
+                for category_id, nominee_id in picks.items() if category_id in winners}
+        rows.append({'user_id': user_id, 'pool_id': pool_id, 'season': season, 'hits': hits,
+                     'correct': sum(hits.values()), 'decided': len(hits), 'total': len(picks)})
+    db.session.bulk_insert_mappings(SeasonStats, rows)
+    return len(rows)
+
+# kind is 'rows' (the query selects ids of model rows to delete) or 'picks'
+# (it selects (ballot id, category key) pairs to drop from packed ballots)
+ConsistencyCheck = namedtuple('ConsistencyCheck', ['name', 'description', 'model', 'kind', 'query'])
+
+def consistency_checks():
+    """Anti-join queries that select broken rows, in the order they should be repaired"""
+    def missing(model, column, target):
+        return (db.select(model.id)
+                .outerjoin(target, column == target.id)
+                .where(target.id.is_(None)))
+
+    pick = db.func.json_each(Ballot.picks).table_valued('key', 'value').alias('pick')
+    pick_category_id = db.cast(pick.c.key, db.Integer)
+    ballot_picks = db.select(Ballot.id, pick.c.key).select_from(Ballot).join(pick, db.true())
+    has_ballot = db.or_(
+        db.exists().where(Prediction.user_id == SeasonStats.user_id,
+                          Prediction.pool_id == SeasonStats.pool_id),
+        db.exists().where(Ballot.user_id == SeasonStats.user_id,
+                          Ballot.pool_id == SeasonStats.pool_id),
+    )
+
+    return [
+        ConsistencyCheck('nominee_missing_category', 'Nominees whose category is gone',
+                         Nominee, 'rows', missing(Nominee, Nominee.category_id, Category)),
+        ConsistencyCheck('prediction_missing_user', 'Predictions by deleted users',
+                         Prediction, 'rows', missing(Prediction, Prediction.user_id, User)),
+        ConsistencyCheck('prediction_missing_pool', 'Predictions in deleted pools',
+                         Prediction, 'rows', missing(Prediction, Prediction.pool_id, Pool)),
+        ConsistencyCheck('prediction_missing_nominee', 'Predictions for deleted nominees',
+                         Prediction, 'rows', missing(Prediction, Prediction.nominee_id, Nominee)),
+        ConsistencyCheck('prediction_wrong_category', "Predictions whose nominee isn't in their category",
+                         Prediction, 'rows',
+                         db.select(Prediction.id)
+                         .join(Nominee, Prediction.nominee_id == Nominee.id)
+                         .where(Nominee.category_id != Prediction.category_id)),
+        ConsistencyCheck('prediction_wrong_season', "Predictions for a category outside the pool's season",
+                         Prediction, 'rows',
+                         db.select(Prediction.id)
+                         .join(Category, Prediction.category_id == Category.id)
+                         .join(Pool, Prediction.pool_id == Pool.id)
+                         .where(Category.season != Pool.season)),
+        ConsistencyCheck('ballot_missing_user', 'Packed ballots of deleted users',
+                         Ballot, 'rows', missing(Ballot, Ballot.user_id, User)),
+        ConsistencyCheck('ballot_missing_pool', 'Packed ballots in deleted pools',
+                         Ballot, 'rows', missing(Ballot, Ballot.pool_id, Pool)),
+        ConsistencyCheck('ballot_pick_missing_nominee', 'Packed picks of deleted nominees',
+                         Ballot, 'picks',
+                         ballot_picks.outerjoin(Nominee, Nominee.id == pick.c.value)
+                         .where(Nominee.id.is_(None))),
+        ConsistencyCheck('ballot_pick_wrong_category', "Packed picks whose nominee isn't in their category",
+                         Ballot, 'picks',
+                         ballot_picks.join(Nominee, Nominee.id == pick.c.value)
+                         .where(Nominee.category_id != pick_category_id)),
+        ConsistencyCheck('ballot_pick_wrong_season', "Packed picks for a category outside the pool's season",
+                         Ballot, 'picks',
+                         ballot_picks.join(Pool, Ballot.pool_id == Pool.id)
+                         .join(Category, Category.id == pick_category_id)
+                         .where(Category.season != Pool.season)),
+        ConsistencyCheck('stats_missing_ballot', 'Stats rollups without a ballot',
+                         SeasonStats, 'rows', db.select(SeasonStats.id).where(~has_ballot)),
+        ConsistencyCheck('stats_wrong_season', "Stats rollups filed under the wrong season",
+                         SeasonStats, 'rows',
+                         db.select(SeasonStats.id)
+                         .join(Pool, SeasonStats.pool_id == Pool.id)
+                         .where(SeasonStats.season != Pool.season)),
+    ]
+
+def verify_consistency(repair=False):
+    """Count (and optionally repair) every inconsistency.
+
+    Each check is one query, plus one statement to fix it, so the cost
+    doesn't depend on how many rows are broken. Rollups are rebuilt after
+    any repair. Runs in the caller's transaction; returns [(check, count)].
+    """
+    results = []
+    for check in consistency_checks():
+        if check.kind == 'picks':
+            broken = db.session.execute(check.query).all()
+            count = len(broken)
+            if repair and broken:
+                drop = {}
+                for ballot_id, key in broken:
+                    drop.setdefault(ballot_id, set()).add(key)
+                for ballot in Ballot.query.filter(Ballot.id.in_(drop)).all():
+                    # Assign a new dict so the change (and version bump) is seen
+                    ballot.picks = {key: nominee_id for key, nominee_id in ballot.picks.items()
+                                    if key not in drop[ballot.id]}
+                db.session.flush()
+        else:
+            count = db.session.scalar(db.select(db.func.count()).select_from(check.query.subquery()))
+            if repair and count:
+                db.session.execute(db.delete(check.model)
+                                   .where(check.model.id.in_(check.query.correlate(None))))
+        results.append((check, count))
+
+    if repair and any(count for _, count in results):
+        backfill_rollups()
+    return results
+
 # Helper function
 def is_admin():
     discord_user = session.get('discord_user')
@@ -96,14 +757,10 @@ def index():
         is_admin_user = user.is_admin if user else False
         
         if user:
-            # Get all predictions for the user across all pools
-            predictions = (Prediction.query
-                         .join(Pool)
-                         .join(Category)
-                         .join(Nominee)
-                         .filter(Prediction.user_id == user.id)
-                         .order_by(Pool.name, Category.name)
-                         .all())
+            # Get the user's predictions across this guild's pools
+            guild_pool_ids = db.select(Pool.id).where(guild_filter())
+            predictions = sorted(resolve_picks(ballot_store.picks(user_id=user.id, pool_ids=guild_pool_ids)),
+                                 key=lambda pick: (pick.pool.name, pick.category.name))
             
             # Group predictions by pool
             for prediction in predictions:
@@ -126,10 +783,12 @@ def login():
 
 @app.before_request
 def make_session_permanent():
-    session.permanent = True
-    app.permanent_session_lifetime = timedelta(days=7)
+    # Only touch the session when needed so unchanged sessions aren't rewritten
+    if not is_sessionless_request() and not session.permanent:
+        session.permanent = True
 
 @app.route('/callback')
+@primary_only
 def callback():
     try:
         token = discord.fetch_token(
@@ -155,28 +814,6 @@ def callback():
             default_avatar_id = int(user_data['discriminator']) % 5
             avatar_url = f"https://cdn.discordapp.com/embed/avatars/{default_avatar_id}.png"
         
-        # Store or update user in database
-        user = User.query.filter_by(discord_id=user_data['id']).first()
-        if not user:
-            user = User(
-                discord_id=user_data['id'],
-                username=user_data['username']
-            )
-            db.session.add(user)
-        else:
-            user.username = user_data['username']
-        
-        db.session.commit()
-
-        # Store user info in session
-        session.permanent = True
-        session['discord_user'] = {
-            'id': user_data['id'],
-            'username': user_data['username'],
-            'avatar_url': avatar_url
-        }
-        session['oauth2_token'] = token
-        
         # Check user's guilds
         guilds_response = discord.get('https://discord.com/api/users/@me/guilds')
         if guilds_response.status_code != 200:
@@ -185,13 +822,40 @@ def callback():
             return redirect(url_for('index'))
             
         guilds = guilds_response.json()
-        user_guild_ids = {str(guild['id']) for guild in guilds}
+        allowed_guilds = {str(guild['id']): guild.get('name', str(guild['id']))
+                          for guild in guilds if str(guild['id']) in ALLOWED_GUILD_IDS}
         
         # Check if user is in any of the allowed guilds
-        if not (user_guild_ids & ALLOWED_GUILD_IDS):
+        if not allowed_guilds:
             flash('You must be a member of the required Discord server to use this application.', 'error')
             return redirect(url_for('index'))
         
+        # Store or update the user in every database their guilds live in
+        for guild_id in one_guild_per_database(allowed_guilds):
+            with app.app_context(), use_guild(guild_id):
+                user = User.query.filter_by(discord_id=user_data['id']).first()
+                if not user:
+                    user = User(
+                        discord_id=user_data['id'],
+                        username=user_data['username']
+                    )
+                    db.session.add(user)
+                else:
+                    user.username = user_data['username']
+                
+                db.session.commit()
+
+        # Store user info in a fresh session so an id planted before login is useless
+        regenerate_session(session)
+        session.permanent = True
+        session['discord_user'] = {
+            'id': user_data['id'],
+            'username': user_data['username'],
+            'avatar_url': avatar_url
+        }
+        session['oauth2_token'] = token
+        select_guild(allowed_guilds)
+        
         flash('Logged in successfully!', 'success')
         return redirect(url_for('index'))
     except Exception as e:
@@ -199,20 +863,33 @@ def callback():
         flash('Authentication failed. Please try again.', 'danger')
         return redirect(url_for('index'))
 
+@app.route('/guild/<guild_id>', methods=['POST'])
+def switch_guild(guild_id):
+    if guild_id not in session.get(GUILDS_KEY, {}):
+        flash('You are not a member of that server.', 'error')
+        return redirect(url_for('index'))
+    
+    session[GUILD_KEY] = guild_id
+    flash(f'Switched to {session[GUILDS_KEY][guild_id]}.', 'success')
+    return redirect(url_for('index'))
+
 @app.route('/logout')
 def logout():
-    session.pop('discord_user', None)
+    # Drop everything (including the OAuth token) and the server-side row
+    session.clear()
+    regenerate_session(session)
     flash('Logged out successfully.', 'success')
     return redirect(url_for('login'))
 
 
 @app.route('/add_nominee', methods=['GET', 'POST'])
+@admission.limit_writes
 def add_nominee():
     if 'discord_user' not in session or not is_admin():
         flash('Access denied. Admins only.', 'error')
         return redirect(url_for('index'))
     
-    categories = Category.query.all()
+    categories = season_categories().all()
     category_id = request.args.get('category_id')
     category = Category.query.get(category_id) if category_id else None
     
@@ -230,6 +907,10 @@ def add_nominee():
                 winner=winner
             )
             db.session.add(new_nominee)
+            if winner:
+                category = Category.query.get(category_id)
+                refresh_category_rollups(category)
+                queue_standings_updates(category.season)
             db.session.commit()
             flash('Nominee added successfully!', 'success')
         else:
@@ -249,8 +930,8 @@ def admin_dashboard():
     if not user or not user.is_admin:
         flash('You must be an admin to access this page.', 'danger')
     
-    categories = Category.query.all()
-    pools = Pool.query.order_by(Pool.created_at.desc()).all()
+    categories = season_categories().all()
+    pools = guild_pools().order_by(Pool.created_at.desc()).all()
     
     # Get selected pool and its predictions
     selected_pool_id = request.args.get('pool_id', type=int)
@@ -258,15 +939,10 @@ def admin_dashboard():
     user_predictions = None
     
     if selected_pool_id:
-        selected_pool = Pool.query.get(selected_pool_id)
+        selected_pool = guild_pools().filter(Pool.id == selected_pool_id).first()
         if selected_pool:
-            user_predictions = (Prediction.query
-                              .join(User)
-                              .join(Category)
-                              .join(Nominee)
-                              .filter(Prediction.pool_id == selected_pool_id)
-                              .order_by(User.username, Category.name)
-                              .all())
+            user_predictions = sorted(resolve_picks(ballot_store.picks(pool_id=selected_pool_id)),
+                                      key=lambda pick: (pick.user.username, pick.category.name))
     
     return render_template('admin_dashboard.html',
                          categories=categories,
@@ -275,16 +951,19 @@ def admin_dashboard():
                          user_predictions=user_predictions)
 
 @app.route('/admin/prediction/<int:prediction_id>/delete', methods=['POST'])
+@admission.limit_writes
 def delete_prediction(prediction_id):
     if 'discord_user' not in session or not is_admin():
         flash('Access denied. Admins only.', 'error')
         return redirect(url_for('index'))
     
     prediction = Prediction.query.get_or_404(prediction_id)
-    pool_id = prediction.pool_id
+    pool_id = guild_pool_or_404(prediction.pool_id).id
     
     try:
         db.session.delete(prediction)
+        db.session.flush()
+        refresh_ballot_rollup(prediction.user_id, prediction.pool)
         db.session.commit()
         flash('Prediction deleted successfully.', 'success')
     except Exception as e:
@@ -294,6 +973,7 @@ def delete_prediction(prediction_id):
     return redirect(url_for('admin_dashboard', pool_id=pool_id))
 
 @app.route('/admin/category/add', methods=['GET', 'POST'])
+@admission.limit_writes
 def add_category():
     # Check if user is logged in and is an admin
     if 'discord_user' not in session:
@@ -315,7 +995,7 @@ def add_category():
         
         try:
             # Create new category
-            category = Category(name=category_name)
+            category = Category(name=category_name, season=current_season())
             db.session.add(category)
             db.session.flush()  # Get the category ID
             
@@ -337,6 +1017,7 @@ def add_category():
     return render_template('add_category.html')
 
 @app.route('/admin/category/edit/<int:category_id>', methods=['GET', 'POST'])
+@admission.limit_writes
 def edit_category(category_id):
     if 'discord_user' not in session or not is_admin():
         flash('Access denied. Admins only.', 'error')
@@ -360,6 +1041,7 @@ def edit_category(category_id):
     return render_template('edit_category.html', category=category)
 
 @app.route('/admin/nominee/edit/<int:nominee_id>', methods=['GET', 'POST'])
+@admission.limit_writes
 def edit_nominee(nominee_id):
     if 'discord_user' not in session or not is_admin():
         flash('Access denied. Admins only.', 'error')
@@ -373,9 +1055,13 @@ def edit_nominee(nominee_id):
         winner = request.form.get('winner') == 'on'
         
         if name:
+            winner_changed = bool(nominee.winner) != winner
             nominee.name = name
             nominee.movie = movie
             nominee.winner = winner
+            if winner_changed:
+                refresh_category_rollups(nominee.category)
+                queue_standings_updates(nominee.category.season)
             db.session.commit()
             flash('Nominee updated successfully!', 'success')
             return redirect(url_for('edit_category', category_id=nominee.category_id))
@@ -385,6 +1071,7 @@ def edit_nominee(nominee_id):
     return render_template('edit_nominee.html', nominee=nominee)
 
 @app.route('/admin/nominee/delete/<int:nominee_id>', methods=['POST'])
+@admission.limit_writes
 def delete_nominee(nominee_id):
     if 'discord_user' not in session or not is_admin():
         flash('Access denied. Admins only.', 'error')
@@ -394,7 +1081,18 @@ def delete_nominee(nominee_id):
     category_id = nominee.category_id
     
     try:
+        was_winner = nominee.winner
+        category = nominee.category
+        # Picks of a deleted nominee can't be scored; take them off the ballots
+        ballots = ballot_store.remove_nominee(nominee.id, category_id)
         db.session.delete(nominee)
+        if was_winner:
+            refresh_category_rollups(category)
+            queue_standings_updates(category.season)
+        db.session.flush()
+        winners = season_winners(category.season)
+        for user_id, pool_id in ballots:
+            refresh_ballot_rollup(user_id, db.session.get(Pool, pool_id), winners)
         db.session.commit()
         flash('Nominee deleted successfully!', 'success')
     except Exception as e:
@@ -405,17 +1103,14 @@ def delete_nominee(nominee_id):
 
 # Add some helper functions for pool management
 def get_active_pools():
-    return Pool.query.filter_by(is_active=True).all()
+    return guild_pools().filter_by(is_active=True).all()
 
 def get_user_predictions(user_id, pool_id):
-    return (Prediction.query
-            .join(Category, Prediction.category_id == Category.id)
-            .join(Nominee, Prediction.nominee_id == Nominee.id)
-            .filter(Prediction.user_id == user_id, Prediction.pool_id == pool_id)
-            .all())
+    return resolve_picks(ballot_store.picks(user_id=user_id, pool_id=pool_id))
 
 # Add a route for pool management
 @app.route('/admin/pools', methods=['GET', 'POST'])
+@admission.limit_writes
 def manage_pools():
     if 'discord_user' not in session or not is_admin():
         flash('Access denied. Admins only.', 'error')
@@ -424,7 +1119,7 @@ def manage_pools():
     if request.method == 'POST':
         pool_name = request.form.get('pool_name')
         if pool_name:
-            new_pool = Pool(name=pool_name)
+            new_pool = Pool(name=pool_name, season=current_season(), guild_id=current_guild())
             db.session.add(new_pool)
             try:
                 db.session.commit()
@@ -433,21 +1128,108 @@ def manage_pools():
                 db.session.rollback()
                 flash('Error creating pool. Name might be duplicate.', 'error')
     
-    pools = Pool.query.all()
-    return render_template('manage_pools.html', pools=pools)
+    pools = guild_pools().order_by(Pool.season.desc(), Pool.name).all()
+    return render_template('manage_pools.html', pools=pools, season=current_season())
 
 @app.route('/admin/pool/<int:pool_id>/toggle', methods=['POST'])
+@admission.limit_writes
 def toggle_pool(pool_id):
     if 'discord_user' not in session or not is_admin():
         flash('Access denied. Admins only.', 'error')
         return redirect(url_for('index'))
     
-    pool = Pool.query.get_or_404(pool_id)
+    pool = guild_pool_or_404(pool_id)
     pool.is_active = not pool.is_active
     db.session.commit()
     flash(f'Pool "{pool.name}" {"activated" if pool.is_active else "deactivated"} successfully!', 'success')
     return redirect(url_for('manage_pools'))
 
+@app.route('/admin/pool/<int:pool_id>/webhook', methods=['POST'])
+@admission.limit_writes
+def set_pool_webhook(pool_id):
+    if 'discord_user' not in session or not is_admin():
+        flash('Access denied. Admins only.', 'error')
+        return redirect(url_for('index'))
+    
+    pool = guild_pool_or_404(pool_id)
+    webhook_url = request.form.get('webhook_url', '').strip()
+    if webhook_url and not webhook_url.startswith(('https://', 'http://')):
+        flash('Webhook URL must start with https://', 'error')
+        return redirect(url_for('manage_pools'))
+    
+    pool.webhook_url = webhook_url or None
+    db.session.commit()
+    flash(f'Webhook for "{pool.name}" {"updated" if webhook_url else "removed"}.', 'success')
+    return redirect(url_for('manage_pools'))
+
+@app.route('/admin/pool/<int:pool_id>/clone', methods=['POST'])
+@admission.limit_writes
+def clone_pool(pool_id):
+    if 'discord_user' not in session or not is_admin():
+        flash('Access denied. Admins only.', 'error')
+        return redirect(url_for('index'))
+    
+    source_pool = guild_pool_or_404(pool_id)
+    new_name = request.form.get('pool_name', '').strip()
+    if not new_name:
+        flash('New pool name is required.', 'error')
+        return redirect(url_for('manage_pools'))
+    
+    try:
+        new_pool, predictions, ballots = copy_pool(source_pool, new_name,
+                                                    copy_ballots=request.form.get('copy_ballots') == 'on')
+        db.session.commit()
+        flash(f'Created "{new_pool.name}" from "{source_pool.name}" '
+              f'({predictions} prediction rows, {ballots} packed ballots copied).', 'success')
+    except Exception as e:
+        db.session.rollback()
+        flash('Error cloning pool. Name might be duplicate.', 'error')
+    return redirect(url_for('manage_pools'))
+
+@app.route('/admin/pools/purge', methods=['POST'])
+@admission.limit_writes
+def purge_pools():
+    if 'discord_user' not in session or not is_admin():
+        flash('Access denied. Admins only.', 'error')
+        return redirect(url_for('index'))
+    
+    requested = request.form.getlist('pool_ids', type=int)
+    pool_ids = [pool_id for (pool_id,) in
+                db.session.query(Pool.id).filter(guild_filter(), Pool.id.in_(requested))]
+    if not pool_ids:
+        flash('Select at least one pool to purge.', 'error')
+        return redirect(url_for('manage_pools'))
+    
+    try:
+        predictions, ballots = purge_pool_predictions(pool_ids)
+        db.session.commit()
+        flash(f'Purged {predictions} prediction rows and {ballots} packed ballots '
+              f'from {len(pool_ids)} pool(s).', 'success')
+    except Exception as e:
+        db.session.rollback()
+        flash('Error purging predictions.', 'error')
+    return redirect(url_for('manage_pools'))
+
+@app.route('/admin/season/rollover', methods=['POST'])
+@admission.limit_writes
+def rollover_season():
+    if 'discord_user' not in session or not is_admin():
+        flash('Access denied. Admins only.', 'error')
+        return redirect(url_for('index'))
+    
+    try:
+        season, categories, pools = start_new_season(request.form.get('season', type=int))
+        db.session.commit()
+        flash(f'Started season {season}: copied {categories} categories and '
+              f'deactivated {pools} pool(s). Import the new nominees next.', 'success')
+    except ValueError as e:
+        db.session.rollback()
+        flash(str(e), 'error')
+    except Exception as e:
+        db.session.rollback()
+        flash('Error rolling over the season.', 'error')
+    return redirect(url_for('manage_pools'))
+
 @app.route('/make_prediction', methods=['GET', 'POST'])
 def select_pool():
     if 'discord_user' not in session:
@@ -456,7 +1238,7 @@ def select_pool():
     
     if request.method == 'POST':
         pool_name = request.form.get('pool_name')
-        pool = Pool.query.filter_by(name=pool_name, is_active=True).first()
+        pool = guild_pools().filter_by(name=pool_name, is_active=True).first()
         
         if pool:
             return redirect(url_for('make_prediction', pool_id=pool.id))
@@ -466,43 +1248,41 @@ def select_pool():
     return render_template('select_pool.html')
 
 @app.route('/make_prediction/<int:pool_id>', methods=['GET', 'POST'])
+@admission.limit_writes
 def make_prediction(pool_id):
     if 'discord_user' not in session:
         flash('You must be logged in to make predictions.', 'error')
         return redirect(url_for('index'))
     
-    pool = Pool.query.get_or_404(pool_id)
+    pool = guild_pool_or_404(pool_id)
     if not pool.is_active:
         flash('This prediction pool is not currently active.', 'error')
         return redirect(url_for('select_pool'))
     
     user = User.query.filter_by(discord_id=session['discord_user']['id']).first()
+    if not user:
+        # e.g. this guild's database has no row for them yet
+        flash('We could not find your account. Please log in again.', 'error')
+        return redirect(url_for('login'))
     
     if request.method == 'POST':
         try:
             # Get all categories and process predictions
-            categories = Category.query.order_by(Category.name).all()
+            categories = season_categories(pool.season).order_by(Category.name).all()
+            nominee_categories = dict(
+                db.session.query(Nominee.id, Nominee.category_id)
+                .filter(Nominee.category_id.in_([category.id for category in categories])))
+            picks = {}
             for category in categories:
                 nominee_id = request.form.get(f'category_{category.id}')
                 if nominee_id:
-                    # Check if prediction already exists
-                    prediction = Prediction.query.filter_by(
-                        user_id=user.id,
-                        category_id=category.id,
-                        pool_id=pool_id).first()
-                    
-                    if prediction:
-                        # Update existing prediction
-                        prediction.nominee_id = nominee_id
-                    else:
-                        # Create new prediction
-                        prediction = Prediction(
-                            user_id=user.id,
-                            nominee_id=nominee_id,
-                            category_id=category.id,
-                            pool_id=pool_id
-                        )
-                        db.session.add(prediction)
+                    nominee_id = int(nominee_id)
+                    if nominee_categories.get(nominee_id) != category.id:
+                        flash(f'Invalid pick for {category.name}. Please try again.', 'error')
+                        return redirect(url_for('make_prediction', pool_id=pool_id))
+                    picks[category.id] = nominee_id
+            ballot_store.save(user.id, pool_id, picks)
+            refresh_ballot_rollup(user.id, pool)
             
             db.session.commit()
             flash('Your predictions have been saved!', 'success')
@@ -514,13 +1294,10 @@ def make_prediction(pool_id):
             flash('There was an error saving your predictions. Please try again.', 'error')
     
     # Get existing predictions for this user and pool
-    existing_predictions = {
-        pred.category_id: pred.nominee_id 
-        for pred in Prediction.query.filter_by(user_id=user.id, pool_id=pool_id).all()
-    }
+    existing_predictions = ballot_store.get(user.id, pool_id)
     
     # Get all categories and their nominees
-    categories = Category.query.order_by(Category.name).all()
+    categories = season_categories(pool.season).order_by(Category.name).all()
     
     return render_template(
         'make_prediction.html',
@@ -530,6 +1307,7 @@ def make_prediction(pool_id):
     )
 
 @app.route('/admin/prediction/delete_user_pool', methods=['POST'])
+@admission.limit_writes
 def delete_user_pool_predictions():
     if 'discord_user' not in session or not is_admin():
         flash('Access denied. Admins only.', 'error')
@@ -542,12 +1320,11 @@ def delete_user_pool_predictions():
         flash('Missing required information.', 'error')
         return redirect(url_for('admin_dashboard'))
     
+    guild_pool_or_404(int(pool_id))
     try:
         # Delete all predictions for the user in the specified pool
-        Prediction.query.filter_by(
-            user_id=user_id,
-            pool_id=pool_id
-        ).delete()
+        ballot_store.delete(int(user_id), int(pool_id))
+        SeasonStats.query.filter_by(user_id=int(user_id), pool_id=int(pool_id)).delete()
         db.session.commit()
         flash('All predictions deleted successfully for this user in the pool.', 'success')
     except Exception as e:
@@ -556,10 +1333,222 @@ def delete_user_pool_predictions():
     
     return redirect(url_for('admin_dashboard', pool_id=pool_id))
 
+@app.route('/stats')
+def my_stats():
+    if 'discord_user' not in session:
+        flash('You must be logged in to see your stats.', 'error')
+        return redirect(url_for('index'))
+    
+    user = User.query.filter_by(discord_id=session['discord_user']['id']).first()
+    rows = []
+    seasons = {}
+    if user:
+        rows = (db.session.query(SeasonStats, Pool.name)
+                .join(Pool, SeasonStats.pool_id == Pool.id)
+                .filter(SeasonStats.user_id == user.id, guild_filter())
+                .order_by(SeasonStats.season.desc(), Pool.name)
+                .all())
+        for stats, _ in rows:
+            totals = seasons.setdefault(stats.season, {'correct': 0, 'decided': 0, 'pools': 0})
+            totals['correct'] += stats.correct
+            totals['decided'] += stats.decided
+            totals['pools'] += 1
+    
+    return render_template('stats.html', rows=rows, seasons=seasons)
+
+@app.route('/stats/season', defaults={'season': None})
+@app.route('/stats/season/<int:season>')
+def season_leaderboard(season):
+    if 'discord_user' not in session:
+        flash('You must be logged in to see stats.', 'error')
+        return redirect(url_for('index'))
+    
+    season = season or current_season()
+    correct = db.func.sum(SeasonStats.correct)
+    decided = db.func.sum(SeasonStats.decided)
+    leaders = (db.session.query(User.username,
+                                correct.label('correct'),
+                                decided.label('decided'),
+                                db.func.count(SeasonStats.id).label('pools'))
+               .join(User, SeasonStats.user_id == User.id)
+               .join(Pool, SeasonStats.pool_id == Pool.id)
+               .filter(SeasonStats.season == season, guild_filter())
+               .group_by(User.id, User.username)
+               .order_by((correct * 1.0 / db.func.nullif(decided, 0)).desc().nullslast(),
+                         correct.desc(), User.username)
+               .all())
+    seasons = [value for (value,) in (db.session.query(SeasonStats.season)
+                                      .join(Pool, SeasonStats.pool_id == Pool.id)
+                                      .filter(guild_filter())
+                                      .distinct()
+                                      .order_by(SeasonStats.season.desc()))]
+    
+    return render_template('season_leaderboard.html', season=season, seasons=seasons, leaders=leaders)
+
+@app.route('/admin/profiler', methods=['GET', 'POST'])
+def admin_profiler():
+    if 'discord_user' not in session or not is_admin():
+        flash('Access denied. Admins only.', 'error')
+        return redirect(url_for('index'))
+    
+    if request.method == 'POST':
+        if request.form.get('action') == 'reset':
+            profiler.reset()
+            flash('Profiler data cleared.', 'success')
+            return redirect(url_for('admin_profiler'))
+        
+        mode = request.form.get('mode', 'sample')
+        try:
+            profiler.configure(
+                enabled=request.form.get('enabled') == 'on',
+                endpoint_pattern=request.form.get('endpoint_pattern', '*').strip(),
+                every_n=int(request.form.get('every_n', 10)),
+                mode=mode,
+                sample_interval=float(request.form.get('sample_interval_ms', 5)) / 1000
+            )
+            flash('Profiler settings updated.', 'success')
+        except ValueError:
+            flash('Invalid profiler settings.', 'error')
+        return redirect(url_for('admin_profiler'))
+    
+    endpoints = sorted(rule.endpoint for rule in app.url_map.iter_rules())
+    return render_template('profiler.html',
+                         profiler=profiler,
+                         modes=PROFILER_MODES,
+                         endpoints=sorted(set(endpoints)),
+                         top_functions=profiler.top_functions())
+
+@app.route('/admin/profiler/collapsed.txt')
+def admin_profiler_collapsed():
+    if 'discord_user' not in session or not is_admin():
+        flash('Access denied. Admins only.', 'error')
+        return redirect(url_for('index'))
+    
+    return Response(profiler.collapsed(), mimetype='text/plain',
+                    headers={'Content-Disposition': 'attachment; filename=profile.collapsed.txt'})
+
+# Ballot similarity (closest rivals and likely duplicate accounts)
+DUPLICATE_THRESHOLD = config.getfloat('Analysis', 'DUPLICATE_THRESHOLD', fallback=1.0)
+DUPLICATE_MIN_PICKS = config.getint('Analysis', 'DUPLICATE_MIN_PICKS', fallback=5)
+ANALYSIS_BLOCK_SIZE = config.getint('Analysis', 'BLOCK_SIZE', fallback=512)
+
+def pool_similarity(pool, threshold=None):
+    """Return (rivals, duplicate clusters, {user_id: username}) for a pool's ballots"""
+    usernames = {}
+    
+    def rows():
+        for row, username in ballot_store.stream(pool.id):
+            usernames[row.user_id] = username
+            yield row.user_id, row.category_id, row.nominee_id
+    
+    matrix = build_matrix(rows())
+    rivals = nearest_rivals(matrix, ANALYSIS_BLOCK_SIZE)
+    clusters = duplicate_clusters(matrix, threshold or DUPLICATE_THRESHOLD, DUPLICATE_MIN_PICKS,
+                                  ANALYSIS_BLOCK_SIZE)
+    return rivals, clusters, usernames
+
+@app.route('/admin/pool/<int:pool_id>/similarity')
+def pool_similarity_report(pool_id):
+    if 'discord_user' not in session or not is_admin():
+        flash('Access denied. Admins only.', 'error')
+        return redirect(url_for('index'))
+    
+    pool = guild_pool_or_404(pool_id)
+    threshold = request.args.get('threshold', type=float) or DUPLICATE_THRESHOLD
+    rivals, clusters, usernames = pool_similarity(pool, threshold)
+    rivals.sort(key=lambda rival: (-rival.similarity, -rival.matches, usernames.get(rival.user_id, '')))
+    
+    return render_template('pool_similarity.html',
+                         pool=pool,
+                         rivals=rivals,
+                         clusters=clusters,
+                         usernames=usernames,
+                         threshold=threshold,
+                         min_picks=DUPLICATE_MIN_PICKS)
+
+# Streaming API for bots and notebooks
+API_POOL_FIELDS = ('id', 'name', 'season', 'is_active', 'created_at')
+API_BALLOT_FIELDS = ('pool_id', 'pool', 'user_id', 'user', 'category_id', 'category',
+                     'nominee_id', 'nominee', 'movie', 'correct', 'updated_at')
+API_CATALOG_FIELDS = ('season', 'category_id', 'category', 'show_movie',
+                      'nominee_id', 'nominee', 'movie', 'winner')
+
+@app.route('/api/pools')
+@api_tokens.require_token
+def api_pools():
+    try:
+        fields = requested_fields(API_POOL_FIELDS)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    
+    query = guild_pools().order_by(Pool.season.desc(), Pool.name).yield_per(api_tokens.batch_size)
+    records = ({field: getattr(pool, field) for field in API_POOL_FIELDS} for pool in query)
+    return ndjson_response(records, fields)
+
+@app.route('/api/pools/<int:pool_id>/ballots')
+@api_tokens.require_token
+def api_pool_ballots(pool_id):
+    pool = guild_pools().filter(Pool.id == pool_id).first()
+    if not pool:
+        return jsonify(error='Pool not found.'), 404
+    try:
+        fields = requested_fields(API_BALLOT_FIELDS)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    
+    # The season's catalog is small (one joined query); ballots are streamed
+    catalog = (db.session.query(Nominee.id, Nominee.name, Nominee.movie, Nominee.winner,
+                                Nominee.category_id, Category.name)
+               .join(Category, Nominee.category_id == Category.id)
+               .filter(Category.season == pool.season)
+               .all())
+    nominees = {nominee_id: (name, movie, winner) for nominee_id, name, movie, winner, _, _ in catalog}
+    categories = {category_id: category_name for *_, category_id, category_name in catalog}
+    decided = {category_id for _, _, _, winner, category_id, _ in catalog if winner}
+    pool_id, pool_name = pool.id, pool.name
+    
+    def records():
+        for row, username in ballot_store.stream(pool_id, api_tokens.batch_size):
+            name, movie, winner = nominees.get(row.nominee_id, (None, None, False))
+            yield {
+                'pool_id': pool_id,
+                'pool': pool_name,
+                'user_id': row.user_id,
+                'user': username,
+                'category_id': row.category_id,
+                'category': categories.get(row.category_id),
+                'nominee_id': row.nominee_id,
+                'nominee': name,
+                'movie': movie,
+                # null until the category has a winner
+                'correct': bool(winner) if row.category_id in decided else None,
+                'updated_at': row.updated_at,
+            }
+    return ndjson_response(records(), fields)
+
+@app.route('/api/catalog')
+@api_tokens.require_token
+def api_catalog():
+    try:
+        fields = requested_fields(API_CATALOG_FIELDS)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    
+    season = request.args.get('season', type=int) or current_season()
+    query = (db.session.query(Category.season, Category.id, Category.name, Category.show_movie,
+                              Nominee.id, Nominee.name, Nominee.movie, Nominee.winner)
+             .join(Nominee, Nominee.category_id == Category.id)
+             .filter(Category.season == season)
+             .order_by(Category.name, Nominee.name)
+             .yield_per(api_tokens.batch_size))
+    records = (dict(zip(API_CATALOG_FIELDS, row)) for row in query)
+    return ndjson_response(records, fields)
+
 # Database initialization
 def init_db(app):
     with app.app_context():
         db.create_all()
+        create_tenant_schemas(db)
 
 @app.context_processor
 def utility_processor():
@@ -575,7 +1564,7 @@ def export():
     import csv
     from datetime import datetime
     
-    with app.app_context():
+    with app.app_context(), read_from_replica():
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
         filename = f'oscars_export_{timestamp}.csv'
         
@@ -584,17 +1573,12 @@ def export():
             # Updated headers to include prediction data
             writer.writerow(['Pool', 'User', 'Category', 'ShowMovie', 'Nominee', 'Movie', 'Prediction', 'Last Updated'])
             
-            # Get all pools
-            pools = Pool.query.all()
+            # Get all pools (just the guild's with manage_db --guild)
+            pools = guild_pools().all()
             for pool in pools:
                 # Get all predictions for this pool
-                predictions = (Prediction.query
-                             .join(User)
-                             .join(Category)
-                             .join(Nominee)
-                             .filter(Prediction.pool_id == pool.id)
-                             .order_by(User.username, Category.name)
-                             .all())
+                predictions = sorted(resolve_picks(ballot_store.picks(pool_id=pool.id)),
+                                     key=lambda pick: (pick.user.username, pick.category.name))
                 
                 # Write predictions
                 for pred in predictions:
@@ -611,8 +1595,8 @@ def export():
                     
                     # Write other nominees in this category (not predicted)
                     other_nominees = (Nominee.query
-                                    .filter(Nominee.category_id == pred.category_id)
-                                    .filter(Nominee.id != pred.nominee_id)
+                                    .filter(Nominee.category_id == pred.category.id)
+                                    .filter(Nominee.id != pred.nominee.id)
                                     .all())
                     
                     for nominee in other_nominees:
@@ -629,8 +1613,16 @@ def export():
         
         print(f"Exported categories, nominees, and predictions to {filename}")
 
+# Compile every template before this worker starts serving requests
+if config.getboolean('Templates', 'WARMUP', fallback=True):
+    warmup_templates(app)
+
 if __name__ == "__main__":
     init_db(app)
+    # With the debug reloader only the child process serves requests
+    if (config.getboolean('Notifications', 'DISPATCH_IN_APP', fallback=True)
+            and os.environ.get('WERKZEUG_RUN_MAIN') == 'true'):
+        webhook_dispatcher.start_thread()
     app.run(
         debug=True, 
         host='localhost', 
@@ -0,0 +1,181 @@
+"""Self-hosted static assets and HTML response compression.
+
+Bootstrap and Bootstrap Icons are normally pulled from jsDelivr. Running
+``python manage_db.py vendor_assets`` downloads them once into
+``static/vendor`` with content-hashed filenames plus precompressed gzip
+(and brotli, when the ``brotli`` package is installed) variants, and writes
+a ``manifest.json`` mapping the logical names to the hashed files. When
+``[Assets] SELF_HOST`` is enabled the templates use those copies instead of
+the CDN.
+"""
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import urllib.request
+
+from flask import request, send_from_directory, url_for
+
+from sessions import sessionless
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+CDN_ASSETS = {
+    'fonts/bootstrap-icons.woff2': 'https://cdn.jsdelivr.net/npm/bootstrap-icons@1.11.3/font/fonts/bootstrap-icons.woff2',
+    'fonts/bootstrap-icons.woff': 'https://cdn.jsdelivr.net/npm/bootstrap-icons@1.11.3/font/fonts/bootstrap-icons.woff',
+    'bootstrap.min.css': 'https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/css/bootstrap.min.css',
+    'bootstrap-icons.css': 'https://cdn.jsdelivr.net/npm/bootstrap-icons@1.11.3/font/bootstrap-icons.css',
+    'bootstrap.bundle.min.js': 'https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/js/bootstrap.bundle.min.js',
+}
+
+MANIFEST_NAME = 'manifest.json'
+COMPRESSIBLE_EXTENSIONS = ('.css', '.js', '.svg', '.json')
+ONE_YEAR = 365 * 24 * 60 * 60
+
+FONT_URL_RE = re.compile(r'url\("?\./fonts/([^"?)]+)(\?[^")]*)?"?\)')
+SOURCE_MAP_RE = re.compile(rb'/[*/]# sourceMappingURL=[^\n]*')
+
+
+def hashed_name(name, data):
+    """Insert a short content hash before the file extension"""
+    digest = hashlib.sha256(data).hexdigest()[:12]
+    base, ext = os.path.splitext(name)
+    return f'{base}.{digest}{ext}'
+
+
+def write_variants(path, data):
+    """Write a file along with its precompressed .gz/.br siblings"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+    if not path.endswith(COMPRESSIBLE_EXTENSIONS):
+        return
+
+    with open(path + '.gz', 'wb') as f:
+        f.write(gzip.compress(data, compresslevel=9, mtime=0))
+    if brotli is not None:
+        with open(path + '.br', 'wb') as f:
+            f.write(brotli.compress(data, quality=11))
+
+
+def vendor_assets(vendor_dir):
+    """Download the CDN assets into vendor_dir and write the manifest"""
+    manifest = {}
+
+    # CDN_ASSETS lists the fonts first so the icon stylesheet can be
+    # rewritten to point at their hashed names.
+    for name, cdn_url in CDN_ASSETS.items():
+        with urllib.request.urlopen(cdn_url, timeout=30) as response:
+            data = response.read()
+
+        if name.endswith('.css') or name.endswith('.js'):
+            data = SOURCE_MAP_RE.sub(b'', data)
+        if name == 'bootstrap-icons.css':
+            text = data.decode('utf-8')
+            text = FONT_URL_RE.sub(
+                lambda m: f'url("./{manifest.get("fonts/" + m.group(1), "fonts/" + m.group(1))}")',
+                text)
+            data = text.encode('utf-8')
+
+        filename = hashed_name(name, data)
+        write_variants(os.path.join(vendor_dir, filename), data)
+        manifest[name] = filename
+        print(f"Vendored {name} -> {filename}")
+
+    with open(os.path.join(vendor_dir, MANIFEST_NAME), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    return manifest
+
+
+def load_manifest(vendor_dir):
+    path = os.path.join(vendor_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def preferred_encoding(available):
+    """Pick the best encoding from available that the client accepts"""
+    accepted = request.accept_encodings
+    for encoding in ('br', 'gzip'):
+        if encoding in available and accepted[encoding]:
+            return encoding
+    return None
+
+
+def init_assets(app, config):
+    """Register the vendored asset route, asset_url helper and compression"""
+    vendor_dir = os.path.join(app.static_folder, 'vendor')
+    self_host = config.getboolean('Assets', 'SELF_HOST', fallback=False)
+    manifest = load_manifest(vendor_dir) if self_host else {}
+    if self_host and not manifest:
+        print("SELF_HOST is enabled but no vendored assets were found; "
+              "run 'python manage_db.py vendor_assets'. Falling back to the CDN.")
+
+    compress = config.getboolean('Assets', 'COMPRESS_RESPONSES', fallback=True)
+    min_size = config.getint('Assets', 'COMPRESS_MIN_SIZE', fallback=1024)
+    level = config.getint('Assets', 'COMPRESS_LEVEL', fallback=6)
+
+    @app.template_global()
+    def asset_url(name):
+        if name in manifest:
+            return url_for('vendor_static', filename=manifest[name])
+        return CDN_ASSETS[name]
+
+    @app.route('/static/vendor/<path:filename>')
+    @sessionless
+    def vendor_static(filename):
+        available = {
+            encoding for encoding, suffix in (('br', '.br'), ('gzip', '.gz'))
+            if os.path.exists(os.path.join(vendor_dir, filename + suffix))
+        }
+        encoding = preferred_encoding(available)
+        suffix = {'br': '.br', 'gzip': '.gz'}.get(encoding, '')
+
+        response = send_from_directory(
+            vendor_dir, filename + suffix,
+            mimetype=mimetypes.guess_type(filename)[0],
+            max_age=ONE_YEAR)
+        response.cache_control.immutable = True
+        response.cache_control.public = True
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+        return response
+
+    if not compress:
+        return
+
+    @app.after_request
+    def compress_response(response):
+        if (response.status_code != 200
+                or response.direct_passthrough
+                or response.is_streamed
+                or response.mimetype != 'text/html'
+                or 'Content-Encoding' in response.headers):
+            return response
+
+        data = response.get_data()
+        if len(data) < min_size:
+            return response
+
+        encoding = preferred_encoding({'br', 'gzip'} if brotli else {'gzip'})
+        if encoding == 'br':
+            response.set_data(brotli.compress(data, quality=min(level, 11)))
+        elif encoding == 'gzip':
+            response.set_data(gzip.compress(data, compresslevel=min(max(level, 1), 9)))
+        else:
+            response.vary.add('Accept-Encoding')
+            return response
+
+        response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+        return response
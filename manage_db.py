@@ -1,7 +1,14 @@
-from app import app, db, User, Category, Nominee, Pool, Prediction
+from app import (app, db, User, Category, Nominee, Pool, ballot_store, resolve_picks,
+                 migrate_ballot_storage, webhook_dispatcher, current_season, season_categories,
+                 copy_pool, purge_pool_predictions, start_new_season, backfill_rollups, verify_consistency,
+                 guild_pools, pool_similarity,
+                 session_store, template_cache_dir)
+from routing import read_from_replica, replicate_sqlite, REPLICA_BIND
+from tenancy import create_tenant_schemas
 import configparser
 import csv
 import os
+import time
 
 def load_config():
     """Load configuration from settings.config"""
@@ -32,6 +39,9 @@ def set_admin(discord_id, admin_status=True):
             user.is_admin = admin_status
             db.session.commit()
             print(f"Updated {user.username}'s admin status to {admin_status}")
+            if session_store:
+                revoked = session_store.revoke_user(discord_id)
+                print(f"Signed out {revoked} active session(s); they will need to log in again")
         else:
             print(f"No user found with Discord ID: {discord_id}")
 
@@ -41,7 +51,7 @@ def list_categories():
     print("-" * 50)
     
     with app.app_context():
-        categories = Category.query.all()
+        categories = season_categories().all()
         for category in categories:
             print(f"\nCategory: {category.name}")
             print("Nominees:")
@@ -86,7 +96,7 @@ def export_categories():
     import csv
     from datetime import datetime
     
-    with app.app_context():
+    with app.app_context(), read_from_replica():
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
         filename = f'categories_export_{timestamp}.csv'
         
@@ -94,7 +104,7 @@ def export_categories():
             writer = csv.writer(csvfile)
             writer.writerow(['Category', 'ShowMovie', 'Nominee', 'Movie', 'Winner'])
             
-            categories = Category.query.order_by(Category.name).all()
+            categories = season_categories().order_by(Category.name).all()
             for category in categories:
                 # If category has no nominees, write just the category
                 if not category.nominees:
@@ -120,7 +130,7 @@ def export_predictions():
     import csv
     from datetime import datetime
     
-    with app.app_context():
+    with app.app_context(), read_from_replica():
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
         filename = f'predictions_export_{timestamp}.csv'
         
@@ -129,13 +139,8 @@ def export_predictions():
             writer.writerow(['Pool', 'User', 'Category', 'Nominee', 'Movie', 'Updated At'])
             
             # Get all predictions across all pools
-            predictions = (Prediction.query
-                         .join(Pool)
-                         .join(User)
-                         .join(Category)
-                         .join(Nominee)
-                         .order_by(Pool.name, User.username, Category.name)
-                         .all())
+            predictions = sorted(resolve_picks(ballot_store.picks()),
+                                 key=lambda pick: (pick.pool.name, pick.user.username, pick.category.name))
             
             for pred in predictions:
                 writer.writerow([
@@ -159,6 +164,7 @@ def import_categories(filename):
     
     try:
         with app.app_context():
+            season = current_season()
             with open(filename, 'r', encoding='utf-8') as csvfile:
                 reader = csv.DictReader(csvfile)
                 
@@ -173,11 +179,12 @@ def import_categories(filename):
                         continue
                     
                     # Find or create category
-                    category = Category.query.filter_by(name=category_name).first()
+                    category = season_categories(season).filter_by(name=category_name).first()
                     if not category:
                         category = Category(
                             name=category_name,
-                            show_movie=show_movie
+                            show_movie=show_movie,
+                            season=season
                         )
                         db.session.add(category)
                         db.session.flush()
@@ -208,6 +215,10 @@ def import_categories(filename):
             db.session.commit()
             print("Categories and nominees imported successfully")
             
+            # Imported winners change everyone's scores
+            backfill_rollups(season)
+            db.session.commit()
+            
     except Exception as e:
         db.session.rollback()
         print(f"Error during import: {e}")
@@ -233,9 +244,10 @@ def import_predictions(filename):
                     nominee_name = row['Nominee'].strip()
                     
                     # Find required records
-                    pool = Pool.query.filter_by(name=pool_name).first()
+                    pool = guild_pools().filter_by(name=pool_name).first()
                     user = User.query.filter_by(username=username).first()
-                    category = Category.query.filter_by(name=category_name).first()
+                    category = (season_categories(pool.season).filter_by(name=category_name).first()
+                                if pool else None)
                     nominee = Nominee.query.filter_by(
                         name=nominee_name,
                         category_id=category.id if category else None
@@ -246,52 +258,260 @@ def import_predictions(filename):
                         print(f"Skipping prediction: {pool_name} - {username} - {category_name} - {nominee_name}")
                         continue
                     
-                    # Find or create prediction
-                    prediction = Prediction.query.filter_by(
-                        user_id=user.id,
-                        category_id=category.id,
-                        pool_id=pool.id
-                    ).first()
+                    updated_at = None
+                    if 'Updated At' in row and row['Updated At']:
+                        try:
+                            updated_at = datetime.strptime(
+                                row['Updated At'],
+                                '%Y-%m-%d %H:%M:%S'
+                            )
+                        except ValueError:
+                            pass  # Use default timestamp if parse fails
                     
-                    if prediction:
-                        # Update existing prediction
-                        prediction.nominee_id = nominee.id
-                        if 'Updated At' in row and row['Updated At']:
-                            try:
-                                prediction.updated_at = datetime.strptime(
-                                    row['Updated At'],
-                                    '%Y-%m-%d %H:%M:%S'
-                                )
-                            except ValueError:
-                                pass  # Keep current timestamp if parse fails
-                    else:
-                        # Create new prediction
-                        prediction = Prediction(
-                            user_id=user.id,
-                            nominee_id=nominee.id,
-                            category_id=category.id,
-                            pool_id=pool.id
-                        )
-                        if 'Updated At' in row and row['Updated At']:
-                            try:
-                                prediction.updated_at = datetime.strptime(
-                                    row['Updated At'],
-                                    '%Y-%m-%d %H:%M:%S'
-                                )
-                            except ValueError:
-                                pass  # Use default timestamp if parse fails
-                        db.session.add(prediction)
+                    ballot_store.save(user.id, pool.id, {category.id: nominee.id}, updated_at=updated_at)
             
             db.session.commit()
             print("Predictions imported successfully")
             
+            backfill_rollups()
+            db.session.commit()
+            
     except Exception as e:
         db.session.rollback()
         print(f"Error during import: {e}")
 
+def migrate_ballots(target):
+    """Convert all ballots between the 'rows' and 'packed' storage layouts"""
+    if target not in ('rows', 'packed'):
+        print("Error: target must be 'rows' or 'packed'")
+        return
+    
+    with app.app_context():
+        try:
+            db.create_all()
+            create_tenant_schemas(db)
+            count = migrate_ballot_storage(target)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error migrating ballots: {e}")
+            return
+        print(f"Migrated {count} ballots to the {target} layout")
+        if ballot_store.name != target:
+            print(f"Set BALLOT_STORAGE = {target} in the [Data] section of settings.config")
+
+def replicate(interval=0):
+    """Copy the primary SQLite database onto the replica, optionally in a loop"""
+    with app.app_context():
+        if REPLICA_BIND not in db.engines:
+            print("No SQLALCHEMY_REPLICA_URI configured in settings.config")
+            return
+        primary_path = db.engines[None].url.database
+        replica_path = db.engines[REPLICA_BIND].url.database
+    
+    while True:
+        replicate_sqlite(primary_path, replica_path)
+        print(f"Replicated {primary_path} -> {replica_path}")
+        if not interval:
+            break
+        time.sleep(interval)
+
+def clone_pool(source_name, new_name, copy_ballots=True):
+    """Create a new pool from an existing one, copying its ballots"""
+    with app.app_context():
+        source_pool = guild_pools().filter_by(name=source_name).first()
+        if not source_pool:
+            print(f"No pool found with name: {source_name}")
+            return
+        try:
+            new_pool, predictions, ballots = copy_pool(source_pool, new_name, copy_ballots)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error cloning pool: {e}")
+            return
+        print(f"Created pool '{new_pool.name}' from '{source_pool.name}': "
+              f"{predictions} prediction rows, {ballots} packed ballots copied")
+
+def purge_pools(pool_names):
+    """Delete all predictions in one or more pools"""
+    with app.app_context():
+        pools = guild_pools().filter(Pool.name.in_(pool_names)).all()
+        missing = set(pool_names) - {pool.name for pool in pools}
+        if missing:
+            print(f"No pool found with name(s): {', '.join(sorted(missing))}")
+            return
+        try:
+            predictions, ballots = purge_pool_predictions([pool.id for pool in pools])
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error purging pools: {e}")
+            return
+        print(f"Purged {predictions} prediction rows and {ballots} packed ballots "
+              f"from {len(pools)} pool(s)")
+
+def assign_guild(guild_id, pool_names=None):
+    """Move pools created before tenancy (or the named pools) into a guild"""
+    with app.app_context():
+        query = Pool.query
+        if pool_names:
+            query = query.filter(Pool.name.in_(pool_names))
+        else:
+            query = query.filter(Pool.guild_id.is_(None))
+        try:
+            count = query.update({Pool.guild_id: guild_id}, synchronize_session=False)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error assigning pools: {e}")
+            return
+        print(f"Assigned {count} pool(s) to guild {guild_id}")
+
+def rollover_season(season=None):
+    """Copy the category list into a new season and deactivate old pools"""
+    with app.app_context():
+        try:
+            season, categories, pools = start_new_season(season)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error rolling over season: {e}")
+            return
+        print(f"Started season {season}: copied {categories} categories, deactivated {pools} pools")
+        print("Import the new season's nominees with import_categories")
+
+def rebuild_rollups(season=None):
+    """Recompute the per-season stats rollups from ballots and winners"""
+    with app.app_context():
+        try:
+            db.create_all()
+            create_tenant_schemas(db)
+            count = backfill_rollups(season)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error rebuilding rollups: {e}")
+            return
+        print(f"Rebuilt {count} rollup rows" + (f" for season {season}" if season else ""))
+
+def verify_data(repair=False):
+    """Report orphaned or mismatched predictions, ballots and rollups; --fix repairs them"""
+    with app.app_context():
+        start = time.perf_counter()
+        try:
+            results = verify_consistency(repair)
+            if repair:
+                db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error verifying data: {e}")
+            return
+        elapsed = time.perf_counter() - start
+        
+        for check, count in results:
+            print(f"{count:8d}  {check.name:30s} {check.description}")
+        total = sum(count for _, count in results)
+        if not total:
+            print(f"No problems found ({elapsed:.2f}s)")
+        elif repair:
+            print(f"Repaired {total} problems and rebuilt rollups ({elapsed:.2f}s)")
+        else:
+            print(f"Found {total} problems ({elapsed:.2f}s); run with --fix to repair them")
+
+def similarity(pool_name, threshold=None):
+    """Print each user's closest rival and any near-identical ballots in a pool"""
+    with app.app_context(), read_from_replica():
+        pool = guild_pools().filter_by(name=pool_name).first()
+        if not pool:
+            print(f"No pool found with name: {pool_name}")
+            return
+        start = time.perf_counter()
+        rivals, clusters, usernames = pool_similarity(pool, threshold)
+        elapsed = time.perf_counter() - start
+    
+    print(f"\n{'User':<24} {'Closest rival':<24} {'Same':>9} {'Similarity':>11}")
+    print("-" * 71)
+    for rival in sorted(rivals, key=lambda rival: (-rival.similarity, -rival.matches)):
+        print(f"{usernames.get(rival.user_id, rival.user_id):<24} "
+              f"{usernames.get(rival.rival_id, rival.rival_id):<24} "
+              f"{rival.matches:>4} / {rival.compared:<2} {rival.similarity:>10.0%}")
+    
+    print(f"\nPossible duplicates: {len(clusters)}")
+    for cluster in clusters:
+        print("  " + ", ".join(str(usernames.get(user_id, user_id)) for user_id in cluster))
+    print(f"\nCompared {len(rivals)} ballots in {elapsed:.2f}s")
+
+def similarity_benchmark(ballots=5000):
+    """Time the similarity analysis on synthetic ballots"""
+    from analysis import benchmark
+    
+    timings, clusters = benchmark(ballots)
+    print(f"\nSimilarity analysis of {ballots} synthetic ballots")
+    print("-" * 60)
+    for step, seconds in timings.items():
+        print(f"{step:<45} {seconds:>10.3f}s")
+    print("-" * 60)
+    print(f"Duplicate clusters found: {clusters}")
+
+def dispatch_notifications():
+    """Run the webhook dispatcher in the foreground (Ctrl+C to stop)"""
+    with app.app_context():
+        db.create_all()
+        create_tenant_schemas(db)
+    print("Dispatching webhook notifications...")
+    try:
+        webhook_dispatcher.run_forever()
+    except KeyboardInterrupt:
+        pass
+
+def webhook_stub(port=5050, rate_limit_every=0):
+    """Run a local HTTP server that stands in for Discord webhooks"""
+    from notifications import run_stub_server
+    run_stub_server(port, rate_limit_every)
+
+def template_report():
+    """Compare compiling each template from source with loading its cached bytecode"""
+    from templating import compile_report
+    
+    if not template_cache_dir:
+        print("No template CACHE_DIR configured in settings.config")
+        return
+    
+    rows = compile_report(app, template_cache_dir)
+    print(f"\n{'Template':<28} {'Cold (ms)':>10} {'Warm (ms)':>10}")
+    print("-" * 50)
+    for name, cold, warm in rows:
+        print(f"{name:<28} {cold * 1000:>10.2f} {warm * 1000:>10.2f}")
+    print("-" * 50)
+    total_cold = sum(cold for _, cold, _ in rows)
+    total_warm = sum(warm for _, _, warm in rows)
+    print(f"{'Total':<28} {total_cold * 1000:>10.2f} {total_warm * 1000:>10.2f}")
+
+def vendor_assets():
+    """Download Bootstrap assets into static/vendor for self-hosting"""
+    from assets import vendor_assets as download_assets
+
+    vendor_dir = os.path.join(app.static_folder, 'vendor')
+    try:
+        manifest = download_assets(vendor_dir)
+    except OSError as e:
+        print(f"Error downloading assets: {e}")
+        return
+    print(f"Vendored {len(manifest)} assets into {vendor_dir}")
+    print("Set SELF_HOST = true in the [Assets] section of settings.config to serve them")
+
 if __name__ == "__main__":
     import sys
     
+    if '--guild' in sys.argv:
+        index = sys.argv.index('--guild')
+        if index + 1 >= len(sys.argv):
+            print("Usage: --guild <guild_id>")
+            sys.exit(1)
+        app.config['GUILD_ID'] = sys.argv[index + 1]
+        del sys.argv[index:index + 2]
+
     if len(sys.argv) < 2:
         print("Available commands:")
         print("  python manage_db.py list_users")
@@ -302,6 +522,21 @@ if __name__ == "__main__":
         print("  python manage_db.py export_predictions")
         print("  python manage_db.py import_categories <filename>")
         print("  python manage_db.py import_predictions <filename>")
+        print("  python manage_db.py migrate_ballots <rows|packed>")
+        print("  python manage_db.py replicate [interval_seconds]")
+        print("  python manage_db.py clone_pool <source_pool> <new_pool> [--no-ballots]")
+        print("  python manage_db.py purge_pools <pool> [<pool> ...]")
+        print("  python manage_db.py rollover_season [season]")
+        print("  python manage_db.py assign_guild <guild_id> [<pool> ...]")
+        print("  python manage_db.py backfill_rollups [season]")
+        print("  python manage_db.py verify_data [--fix]")
+        print("  python manage_db.py similarity <pool> [threshold]")
+        print("  python manage_db.py similarity_benchmark [ballots]")
+        print("  python manage_db.py dispatch_notifications")
+        print("  python manage_db.py webhook_stub [port] [rate_limit_every]")
+        print("  python manage_db.py template_report")
+        print("  python manage_db.py vendor_assets")
+        print("Add --guild <guild_id> to work in a guild's pools (and database, if it has one)")
         sys.exit(1)
 
     command = sys.argv[1]
@@ -335,5 +570,51 @@ if __name__ == "__main__":
             print("Usage: python manage_db.py import_predictions <filename>")
             sys.exit(1)
         import_predictions(sys.argv[2])
+    elif command == "migrate_ballots":
+        if len(sys.argv) < 3:
+            print("Error: Please provide the target layout")
+            print("Usage: python manage_db.py migrate_ballots <rows|packed>")
+            sys.exit(1)
+        migrate_ballots(sys.argv[2])
+    elif command == "replicate":
+        replicate(float(sys.argv[2]) if len(sys.argv) > 2 else 0)
+    elif command == "clone_pool":
+        if len(sys.argv) < 4:
+            print("Usage: python manage_db.py clone_pool <source_pool> <new_pool> [--no-ballots]")
+            sys.exit(1)
+        clone_pool(sys.argv[2], sys.argv[3], copy_ballots='--no-ballots' not in sys.argv[4:])
+    elif command == "purge_pools":
+        if len(sys.argv) < 3:
+            print("Usage: python manage_db.py purge_pools <pool> [<pool> ...]")
+            sys.exit(1)
+        purge_pools(sys.argv[2:])
+    elif command == "assign_guild":
+        if len(sys.argv) < 3:
+            print("Usage: python manage_db.py assign_guild <guild_id> [<pool> ...]")
+            sys.exit(1)
+        assign_guild(sys.argv[2], sys.argv[3:])
+    elif command == "rollover_season":
+        rollover_season(int(sys.argv[2]) if len(sys.argv) > 2 else None)
+    elif command == "backfill_rollups":
+        rebuild_rollups(int(sys.argv[2]) if len(sys.argv) > 2 else None)
+    elif command == "verify_data":
+        verify_data('--fix' in sys.argv[2:])
+    elif command == "similarity":
+        if len(sys.argv) < 3:
+            print("Usage: python manage_db.py similarity <pool> [threshold]")
+            sys.exit(1)
+        similarity(sys.argv[2], float(sys.argv[3]) if len(sys.argv) > 3 else None)
+    elif command == "similarity_benchmark":
+        similarity_benchmark(int(sys.argv[2]) if len(sys.argv) > 2 else 5000)
+    elif command == "dispatch_notifications":
+        dispatch_notifications()
+    elif command == "webhook_stub":
+        port = int(sys.argv[2]) if len(sys.argv) > 2 else 5050
+        rate_limit_every = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+        webhook_stub(port, rate_limit_every)
+    elif command == "template_report":
+        template_report()
+    elif command == "vendor_assets":
+        vendor_assets()
     else:
         print(f"Unknown command: {command}") 
\ No newline at end of file
@@ -0,0 +1,192 @@
+"""Background delivery of pool standings to Discord webhooks.
+
+Winner changes only write rows to a persistent outbox (one row per pool,
+so a burst of changes coalesces into a single update). The dispatcher
+polls the outbox, builds each pool's current standings and posts them
+concurrently over a shared aiohttp session, honouring 429 rate limits.
+Rows are only deleted once delivered, so nothing is lost on restart.
+Guilds with their own database each have their own outbox, and the
+dispatcher drains all of them.
+"""
+import asyncio
+import json
+import threading
+from collections import namedtuple
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import aiohttp
+
+from tenancy import all_databases, use_guild
+
+Delivery = namedtuple('Delivery', ['guild_id', 'outbox_id', 'revision', 'url', 'payload'])
+Result = namedtuple('Result', ['delivery', 'status', 'retry_after', 'error'])
+
+MAX_BACKOFF_SECONDS = 300
+
+
+class WebhookDispatcher:
+    """Drain the webhook outbox in a background asyncio loop"""
+
+    def __init__(self, app, db, outbox_model, build_payload, config):
+        self.app = app
+        self.db = db
+        self.outbox = outbox_model
+        self.build_payload = build_payload
+        self.poll_seconds = config.getfloat('Notifications', 'POLL_SECONDS', fallback=2)
+        self.concurrency = config.getint('Notifications', 'CONCURRENCY', fallback=8)
+        self.max_attempts = config.getint('Notifications', 'MAX_ATTEMPTS', fallback=8)
+        self.timeout = config.getfloat('Notifications', 'TIMEOUT_SECONDS', fallback=10)
+        self.batch_size = config.getint('Notifications', 'BATCH_SIZE', fallback=50)
+
+    def start_thread(self):
+        thread = threading.Thread(target=self.run_forever, name='webhook-dispatcher', daemon=True)
+        thread.start()
+        return thread
+
+    def run_forever(self):
+        asyncio.run(self._run())
+
+    async def _run(self):
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        async with aiohttp.ClientSession(timeout=timeout, connector=connector) as http:
+            while True:
+                try:
+                    await self.dispatch_due(http)
+                except Exception as e:
+                    print(f"Webhook dispatcher error: {e}")
+                await asyncio.sleep(self.poll_seconds)
+
+    async def dispatch_due(self, http):
+        """Send every due outbox entry once; returns the number attempted"""
+        loop = asyncio.get_running_loop()
+        deliveries = []
+        for guild_id in all_databases(self.app):
+            deliveries += await loop.run_in_executor(None, self._claim_due, guild_id)
+        if not deliveries:
+            return 0
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+        results = await asyncio.gather(*(self._send(http, semaphore, d) for d in deliveries))
+        by_guild = {}
+        for result in results:
+            by_guild.setdefault(result.delivery.guild_id, []).append(result)
+        for guild_id, guild_results in by_guild.items():
+            await loop.run_in_executor(None, self._record, guild_id, guild_results)
+        return len(results)
+
+    async def _send(self, http, semaphore, delivery):
+        async with semaphore:
+            try:
+                async with http.post(delivery.url, json=delivery.payload) as response:
+                    if response.status == 429:
+                        return Result(delivery, 'retry', await retry_after_seconds(response), None)
+                    if response.status >= 400:
+                        return Result(delivery, 'error', None, f'HTTP {response.status}')
+                    return Result(delivery, 'sent', None, None)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                return Result(delivery, 'error', None, str(e) or type(e).__name__)
+
+    def _claim_due(self, guild_id):
+        with self.app.app_context(), use_guild(guild_id):
+            now = datetime.utcnow()
+            entries = (self.outbox.query
+                       .filter(self.outbox.due_at <= now)
+                       .order_by(self.outbox.due_at)
+                       .limit(self.batch_size)
+                       .all())
+            deliveries = []
+            for entry in entries:
+                if not entry.pool or not entry.pool.webhook_url:
+                    # Webhook removed since the update was queued
+                    self.db.session.delete(entry)
+                    continue
+                deliveries.append(Delivery(guild_id, entry.id, entry.revision, entry.pool.webhook_url,
+                                           self.build_payload(entry.pool)))
+            self.db.session.commit()
+            return deliveries
+
+    def _record(self, guild_id, results):
+        with self.app.app_context(), use_guild(guild_id):
+            now = datetime.utcnow()
+            for result in results:
+                entry = self.db.session.get(self.outbox, result.delivery.outbox_id)
+                if entry is None:
+                    continue
+
+                if result.status == 'sent':
+                    if entry.revision == result.delivery.revision:
+                        self.db.session.delete(entry)
+                    else:
+                        # Winners changed again while we were sending
+                        entry.due_at = now
+                elif result.status == 'retry':
+                    entry.due_at = now + timedelta(seconds=result.retry_after)
+                else:
+                    entry.attempts += 1
+                    entry.last_error = result.error[:200]
+                    if entry.attempts >= self.max_attempts:
+                        print(f"Giving up on webhook for pool {entry.pool_id}: {result.error}")
+                        self.db.session.delete(entry)
+                    else:
+                        backoff = min(2 ** entry.attempts, MAX_BACKOFF_SECONDS)
+                        entry.due_at = now + timedelta(seconds=backoff)
+            self.db.session.commit()
+
+
+async def retry_after_seconds(response):
+    """Read the rate-limit delay from a 429 response (header or Discord JSON body)"""
+    header = response.headers.get('Retry-After')
+    if header:
+        try:
+            return float(header)
+        except ValueError:
+            pass
+    try:
+        body = await response.json(content_type=None)
+        return float(body.get('retry_after', 1))
+    except (ValueError, TypeError, AttributeError, aiohttp.ContentTypeError):
+        return 1.0
+
+
+def run_stub_server(port=5050, rate_limit_every=0):
+    """Local stand-in for Discord webhooks that prints what it receives.
+
+    With rate_limit_every=N every Nth request is answered with a 429.
+    """
+    counter = {'requests': 0}
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            with lock:
+                counter['requests'] += 1
+                limited = rate_limit_every and counter['requests'] % rate_limit_every == 0
+
+            if limited:
+                payload = json.dumps({'message': 'You are being rate limited.', 'retry_after': 1.0}).encode()
+                self.send_response(429)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+                print(f"[429] {self.path}")
+                return
+
+            print(f"[204] {self.path}\n{body.decode('utf-8', 'replace')}\n")
+            self.send_response(204)
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('localhost', port), Handler)
+    print(f"Webhook stub listening on http://localhost:{port}/<anything>")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,218 @@
+"""On-demand request profiling, controlled from the admin profiler page.
+
+When enabled, one in every N requests whose endpoint matches a pattern is
+profiled either with cProfile or by sampling the request thread's stack.
+Results are aggregated in memory (per worker process) and exposed as a
+top-functions table and as collapsed stacks that flamegraph.pl or
+speedscope can read. When disabled the only cost is one attribute check
+per request.
+"""
+import cProfile
+import fnmatch
+import os
+import pstats
+import sys
+import threading
+from collections import Counter
+
+from flask import g, request
+
+MODES = ('sample', 'cprofile')
+MAX_DISTINCT_STACKS = 50000
+MAX_STACK_DEPTH = 100
+
+
+class StackSampler(threading.Thread):
+    """Sample one thread's Python stack at a fixed interval until stopped"""
+
+    def __init__(self, thread_id, interval):
+        super().__init__(name='profiler-sampler', daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = Counter()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+                frame = frame.f_back
+            self.samples[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        return self.samples
+
+
+class RequestProfiler:
+    def __init__(self):
+        self.enabled = False
+        self.endpoint_pattern = '*'
+        self.every_n = 10
+        self.mode = 'sample'
+        self.sample_interval = 0.005
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._clear()
+
+    def _clear(self):
+        self.seen = 0
+        self.profiled = 0
+        self.stacks = Counter()
+        self.stats = None
+
+    def configure(self, enabled, endpoint_pattern, every_n, mode, sample_interval):
+        if mode not in MODES:
+            raise ValueError(f'Unknown profiling mode: {mode}')
+        sample_interval = max(0.001, sample_interval)
+        with self._lock:
+            # Samples are counts of the interval, so they can't be mixed across intervals
+            if mode != self.mode or sample_interval != self.sample_interval:
+                self._clear()
+            self.endpoint_pattern = endpoint_pattern or '*'
+            self.every_n = max(1, every_n)
+            self.mode = mode
+            self.sample_interval = sample_interval
+            self.enabled = enabled
+
+    def init_app(self, app):
+        app.before_request(self._start)
+        app.teardown_request(self._stop)
+
+    def _start(self):
+        if not self.enabled:
+            return
+        if not request.endpoint or not fnmatch.fnmatchcase(request.endpoint, self.endpoint_pattern):
+            return
+        with self._lock:
+            self.seen += 1
+            if self.seen % self.every_n:
+                return
+
+        if self.mode == 'cprofile':
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Another request is already being profiled on this interpreter
+                return
+            g._profiler = profile
+        else:
+            sampler = StackSampler(threading.get_ident(), self.sample_interval)
+            sampler.start()
+            g._profiler = sampler
+
+    def _stop(self, exc=None):
+        profiler = g.pop('_profiler', None)
+        if profiler is None:
+            return
+
+        if isinstance(profiler, cProfile.Profile):
+            profiler.disable()
+            with self._lock:
+                if self.stats is None:
+                    self.stats = pstats.Stats(profiler)
+                else:
+                    self.stats.add(profiler)
+                self.profiled += 1
+        else:
+            samples = profiler.stop()
+            with self._lock:
+                if profiler.interval != self.sample_interval:
+                    return  # started before the interval was changed
+                for stack, count in samples.items():
+                    if stack in self.stacks or len(self.stacks) < MAX_DISTINCT_STACKS:
+                        self.stacks[stack] += count
+                    else:
+                        self.stacks['[truncated]'] += count
+                self.profiled += 1
+
+    def collapsed(self):
+        """Aggregated data in collapsed-stack format, one stack per line.
+
+        Sampled stacks are counted in samples; cProfile data is rebuilt
+        from the call graph and counted in microseconds.
+        """
+        with self._lock:
+            stacks = self._stacks_from_stats() if self.stats is not None else self.stacks
+            lines = [f'{stack} {count}' for stack, count in stacks.most_common()]
+        return '\n'.join(lines) + '\n' if lines else ''
+
+    def _stacks_from_stats(self):
+        """Approximate stacks from pstats' caller graph.
+
+        cProfile only records caller -> callee totals, so a function's time
+        is split between the paths reaching it in proportion to the time
+        each caller spent in it (as flameprof and gprof2dot do).
+        """
+        stats = self.stats.stats
+        callees = {}
+        for func, (_, _, _, _, callers) in stats.items():
+            for caller, (_, _, _, cumtime) in callers.items():
+                callees.setdefault(caller, []).append((func, cumtime))
+
+        def label(func):
+            filename, _, name = func
+            return f'{os.path.basename(filename)}:{name}'
+
+        stacks = Counter()
+        # (function, its share of the function's total time, path above it)
+        pending = [(func, 1.0, ()) for func, (_, _, _, _, callers) in stats.items() if not callers]
+        while pending:
+            func, share, path = pending.pop()
+            _, _, tottime, cumtime, _ = stats[func]
+            path += (label(func),)
+            micros = int(tottime * share * 1e6)
+            if micros and (len(stacks) < MAX_DISTINCT_STACKS or ';'.join(path) in stacks):
+                stacks[';'.join(path)] += micros
+            if len(path) >= MAX_STACK_DEPTH:
+                continue
+            for callee, callee_time in callees.get(func, ()):
+                total = stats[callee][3]
+                if share * callee_time < 1e-6 or label(callee) in path:
+                    continue  # under a microsecond, or recursion (folded into the outer call)
+                pending.append((callee, share * callee_time / total, path))
+        return stacks
+
+    def top_functions(self, limit=30):
+        """Rows of the hottest functions from whichever data has been collected"""
+        with self._lock:
+            if self.stats is not None:
+                return self._top_from_stats(limit)
+            return self._top_from_samples(limit)
+
+    def _top_from_stats(self, limit):
+        rows = []
+        for (filename, line, name), (_, ncalls, tottime, cumtime, _) in self.stats.stats.items():
+            rows.append({
+                'function': f'{os.path.basename(filename)}:{line}({name})',
+                'calls': ncalls,
+                'self': tottime,
+                'total': cumtime,
+            })
+        rows.sort(key=lambda row: row['self'], reverse=True)
+        return rows[:limit]
+
+    def _top_from_samples(self, limit):
+        own = Counter()
+        inclusive = Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(';')
+            own[frames[-1]] += count
+            for frame in set(frames):
+                inclusive[frame] += count
+
+        seconds = self.sample_interval
+        return [
+            {'function': frame, 'calls': None, 'self': count * seconds, 'total': inclusive[frame] * seconds}
+            for frame, count in own.most_common(limit)
+        ]
@@ -0,0 +1,109 @@
+"""Read/write database routing with optional read-replica support.
+
+When ``[Flask] SQLALCHEMY_REPLICA_URI`` is set, queries issued while
+handling GET/HEAD requests (and inside ``read_from_replica()`` blocks, used
+by the exports) are sent to the replica. Everything else - POST handlers,
+flushes, bulk UPDATE/DELETE statements and manage_db writers - uses the
+primary database.
+
+After a user submits a write (or visits a primary_only view, which
+writes on GET) their session is pinned to the primary for
+READ_YOUR_WRITES_SECONDS, so the page they are redirected to shows their
+change even if the replica has not caught up yet.
+
+Guilds with their own database (see tenancy.py) always use it; the
+replica only mirrors the shared database.
+"""
+import sqlite3
+import time
+from contextlib import contextmanager
+
+from flask import g, has_app_context, request, session
+from flask_sqlalchemy.session import Session
+
+from sessions import is_sessionless_request
+from tenancy import tenant_bind
+
+REPLICA_BIND = 'replica'
+PRIMARY_UNTIL_KEY = 'primary_until'
+
+
+class RoutingSession(Session):
+    """Flask-SQLAlchemy session that sends plain reads to the replica when allowed"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and has_app_context():
+            tenant = tenant_bind()
+            if tenant:
+                return self._db.engines[tenant]
+        if (bind is None
+                and not self._flushing
+                and not getattr(clause, 'is_dml', False)
+                and has_app_context()
+                and g.get('use_replica')
+                and REPLICA_BIND in self._db.engines):
+            return self._db.engines[REPLICA_BIND]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def primary_only(view):
+    """Mark a view that writes on GET (e.g. the OAuth callback) as primary-only"""
+    view.primary_only = True
+    return view
+
+
+@contextmanager
+def read_from_replica():
+    """Route reads inside the block to the replica (needs an app context)"""
+    previous = g.get('use_replica', False)
+    g.use_replica = True
+    try:
+        yield
+    finally:
+        g.use_replica = previous
+
+
+def init_routing(app, config):
+    """Configure the replica bind and the per-request routing hooks"""
+    replica_uri = config.get('Flask', 'SQLALCHEMY_REPLICA_URI', fallback='')
+    if not replica_uri:
+        return
+
+    binds = app.config.setdefault('SQLALCHEMY_BINDS', {})
+    binds[REPLICA_BIND] = replica_uri
+    sticky_seconds = config.getint('Flask', 'READ_YOUR_WRITES_SECONDS', fallback=10)
+
+    @app.before_request
+    def choose_database():
+        if is_sessionless_request():
+            return
+        view = app.view_functions.get(request.endpoint)
+        g.use_replica = (
+            request.method in ('GET', 'HEAD')
+            and not getattr(view, 'primary_only', False)
+            and session.get(PRIMARY_UNTIL_KEY, 0) <= time.time()
+        )
+
+    @app.after_request
+    def pin_writer_to_primary(response):
+        # primary_only views write on GET too (the OAuth callback creates the user)
+        view = app.view_functions.get(request.endpoint)
+        writes = (request.method not in ('GET', 'HEAD', 'OPTIONS')
+                  or getattr(view, 'primary_only', False))
+        if writes and response.status_code < 400:
+            session[PRIMARY_UNTIL_KEY] = time.time() + sticky_seconds
+        return response
+
+
+def replicate_sqlite(primary_path, replica_path):
+    """Copy a SQLite primary onto its replica file using the online backup API.
+
+    A stand-in for real replication so routing can be exercised locally.
+    """
+    source = sqlite3.connect(primary_path)
+    target = sqlite3.connect(replica_path, timeout=30)
+    try:
+        source.backup(target)
+    finally:
+        target.close()
+        source.close()
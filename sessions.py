@@ -0,0 +1,269 @@
+"""Server-side sessions stored in a local SQLite file with an in-process LRU.
+
+The cookie only carries a signed, opaque session id. Session data (the
+Discord user and OAuth token) stays on the server and is only written back
+when it actually changes, or when a permanent session is past the halfway
+point of its lifetime. Because sessions are indexed by Discord id, every
+session for a user can be revoked at once, e.g. after their admin status
+changes.
+"""
+import copy
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from flask import current_app, request
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from itsdangerous import BadSignature, Signer
+from werkzeug.datastructures import CallbackDict
+from werkzeug.exceptions import HTTPException
+
+SIGNER_SALT = 'oscar-pool-session'
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, new=False, expires=None):
+        def on_update(self):
+            self.modified = True
+            self.accessed = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.expires = expires
+        self.modified = False
+        self.replaced_sid = None
+        # Only reads mark the session accessed, so untouched responses don't vary on Cookie
+        self.accessed = False
+
+    def __getitem__(self, key):
+        self.accessed = True
+        return super().__getitem__(key)
+
+    def get(self, key, default=None):
+        self.accessed = True
+        return super().get(key, default)
+
+    def setdefault(self, key, default=None):
+        self.accessed = True
+        return super().setdefault(key, default)
+
+    def regenerate(self):
+        """Move the data to a fresh session id; the old row is deleted on save"""
+        if not self.new and self.replaced_sid is None:
+            self.replaced_sid = self.sid
+        self.sid = secrets.token_urlsafe(32)
+        self.new = True
+        self.modified = True
+
+
+class SessionStore:
+    """SQLite-backed session rows fronted by a small LRU of decoded sessions.
+
+    Cached entries are trusted for cache_ttl seconds, which bounds how long
+    another process's revocation can take to be noticed.
+    """
+
+    def __init__(self, path, cache_size=1024, cache_ttl=60):
+        self.path = path
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.serializer = TaggedJSONSerializer()
+        conn = self._connect()
+        conn.execute('CREATE TABLE IF NOT EXISTS sessions '
+                     '(id TEXT PRIMARY KEY, discord_id TEXT, data TEXT NOT NULL, expires REAL)')
+        conn.execute('CREATE INDEX IF NOT EXISTS ix_sessions_discord_id ON sessions (discord_id)')
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def _cache_put(self, sid, data, expires):
+        with self._lock:
+            self._cache[sid] = (data, expires, time.monotonic())
+            self._cache.move_to_end(sid)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def _cache_drop(self, sids):
+        with self._lock:
+            for sid in sids:
+                self._cache.pop(sid, None)
+
+    def load(self, sid):
+        """Return (data, expires) for a live session, or None"""
+        now = time.time()
+        with self._lock:
+            cached = self._cache.get(sid)
+            if cached and time.monotonic() - cached[2] < self.cache_ttl:
+                self._cache.move_to_end(sid)
+                data, expires, _ = cached
+                if expires is None or expires > now:
+                    return copy.deepcopy(data), expires
+                return None
+
+        row = self._connect().execute('SELECT data, expires FROM sessions WHERE id = ?', (sid,)).fetchone()
+        if row is None or (row[1] is not None and row[1] <= now):
+            self._cache_drop([sid])
+            return None
+        data = self.serializer.loads(row[0])
+        self._cache_put(sid, data, row[1])
+        return copy.deepcopy(data), row[1]
+
+    def save(self, sid, data, expires, new=True):
+        """Write a session; returns False if an existing one has been revoked.
+
+        Existing sessions are only updated, never re-inserted, so a session
+        revoked by another process (while still cached here) can't be
+        written back.
+        """
+        discord_user = data.get('discord_user') or {}
+        values = (discord_user.get('id'), self.serializer.dumps(dict(data)), expires, sid)
+        conn = self._connect()
+        if new:
+            conn.execute('INSERT OR REPLACE INTO sessions (discord_id, data, expires, id) VALUES (?, ?, ?, ?)',
+                         values)
+        elif not conn.execute('UPDATE sessions SET discord_id = ?, data = ?, expires = ? WHERE id = ?',
+                              values).rowcount:
+            self._cache_drop([sid])
+            return False
+        self._cache_put(sid, copy.deepcopy(dict(data)), expires)
+        return True
+
+    def delete(self, sid):
+        self._connect().execute('DELETE FROM sessions WHERE id = ?', (sid,))
+        self._cache_drop([sid])
+
+    def revoke_user(self, discord_id):
+        """Delete every session belonging to a Discord user; returns the count"""
+        conn = self._connect()
+        sids = [sid for (sid,) in conn.execute('SELECT id FROM sessions WHERE discord_id = ?', (discord_id,))]
+        conn.execute('DELETE FROM sessions WHERE discord_id = ?', (discord_id,))
+        self._cache_drop(sids)
+        return len(sids)
+
+    def purge_expired(self):
+        return self._connect().execute('DELETE FROM sessions WHERE expires <= ?', (time.time(),)).rowcount
+
+
+class ServerSideSessionInterface(SessionInterface):
+    def __init__(self, store):
+        self.store = store
+
+    def _signer(self, app):
+        return Signer(app.secret_key, salt=SIGNER_SALT)
+
+    def _sessionless(self, app, request):
+        # Sessions are opened before Flask matches the URL, so match it here
+        try:
+            endpoint, _ = app.create_url_adapter(request).match()
+        except HTTPException:
+            return False
+        return getattr(app.view_functions.get(endpoint), 'sessionless', False)
+
+    def open_session(self, app, request):
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        if cookie and not self._sessionless(app, request):
+            try:
+                sid = self._signer(app).unsign(cookie).decode('ascii')
+            except BadSignature:
+                sid = None
+            loaded = self.store.load(sid) if sid else None
+            if loaded:
+                data, expires = loaded
+                return ServerSideSession(data, sid=sid, expires=expires)
+        return ServerSideSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if session.accessed:
+            response.vary.add('Cookie')
+
+        if session.replaced_sid:
+            self.store.delete(session.replaced_sid)
+
+        # A session holding nothing but the permanent flag isn't worth storing
+        if not any(key != '_permanent' for key in session):
+            if session.modified and (not session.new or session.replaced_sid):
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        expires = self.get_expiration_time(app, session)
+        expires_ts = expires.timestamp() if expires else None
+        lifetime = app.permanent_session_lifetime.total_seconds()
+        # Extend a permanent session only once half of its lifetime has passed
+        needs_refresh = (expires_ts is not None and session.expires is not None
+                         and session.expires - time.time() < lifetime / 2)
+
+        if not (session.new or session.modified or needs_refresh):
+            return
+
+        if not self.store.save(session.sid, session, expires_ts, new=session.new):
+            # Revoked since it was loaded (possibly from this worker's cache)
+            response.delete_cookie(name, domain=domain, path=path)
+            return
+        if session.new and secrets.randbelow(100) == 0:
+            self.store.purge_expired()
+
+        response.set_cookie(
+            name,
+            self._signer(app).sign(session.sid).decode('ascii'),
+            expires=expires,
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+        )
+
+
+def sessionless(view):
+    """Mark a view that never uses the session (e.g. immutable static files).
+
+    Session hooks skip it, so it gets no session lookup and no Vary: Cookie.
+    """
+    view.sessionless = True
+    return view
+
+
+def is_sessionless_request():
+    view = current_app.view_functions.get(request.endpoint)
+    return getattr(view, 'sessionless', False)
+
+
+def regenerate_session(session):
+    """Issue a new session id (at login/logout) so a planted id can't be reused.
+
+    Cookie sessions have no server-side id, so there is nothing to do.
+    """
+    if isinstance(session, ServerSideSession):
+        session.regenerate()
+
+
+def init_sessions(app, config):
+    """Install the server-side session interface unless BACKEND = cookie.
+
+    Returns the SessionStore, or None when Flask's cookie sessions are used.
+    """
+    if config.get('Sessions', 'BACKEND', fallback='server') != 'server':
+        return None
+    store = SessionStore(
+        config.get('Sessions', 'STORE_FILE', fallback='sessions.db'),
+        cache_size=config.getint('Sessions', 'CACHE_SIZE', fallback=1024),
+        cache_ttl=config.getfloat('Sessions', 'CACHE_TTL_SECONDS', fallback=60),
+    )
+    app.session_interface = ServerSideSessionInterface(store)
+    return store
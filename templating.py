@@ -0,0 +1,86 @@
+"""Persistent Jinja bytecode cache, template warmup and cold-start timing.
+
+Compiled templates are cached on disk in ``[Templates] CACHE_DIR`` so a
+fresh worker loads bytecode instead of parsing and compiling every
+template. With WARMUP enabled every template is loaded when the app is
+imported, before the worker accepts traffic. The first request each
+worker serves for an endpoint is timed and printed so cold and warm starts
+can be compared.
+"""
+import os
+import threading
+import time
+
+from flask import g, request
+from jinja2 import Environment, FileSystemBytecodeCache
+
+
+def init_templates(app, config):
+    """Configure the bytecode cache; must run before app.jinja_env is first used"""
+    cache_dir = config.get('Templates', 'CACHE_DIR',
+                           fallback=os.path.join(app.instance_path, 'jinja_cache'))
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        app.jinja_options = {**app.jinja_options, 'bytecode_cache': FileSystemBytecodeCache(cache_dir)}
+
+    if config.getboolean('Templates', 'LOG_FIRST_REQUESTS', fallback=True):
+        _time_first_requests(app)
+
+    return cache_dir
+
+
+def warmup_templates(app):
+    """Load every template into the environment's cache; returns {name: seconds}"""
+    timings = {}
+    for name in app.jinja_env.list_templates():
+        start = time.perf_counter()
+        app.jinja_env.get_template(name)
+        timings[name] = time.perf_counter() - start
+    app.config['TEMPLATES_WARMED'] = True
+    return timings
+
+
+def compile_report(app, cache_dir):
+    """Time loading every template cold (parse and compile) and from bytecode.
+
+    Uses fresh environments so the app's own in-memory cache doesn't hide
+    the cost. Returns rows of (name, cold seconds, warm seconds).
+    """
+    def load_all(bytecode_cache):
+        env = Environment(loader=app.jinja_env.loader, bytecode_cache=bytecode_cache)
+        timings = {}
+        for name in env.list_templates():
+            start = time.perf_counter()
+            env.get_template(name)
+            timings[name] = time.perf_counter() - start
+        return timings
+
+    cold = load_all(None)
+    cache = FileSystemBytecodeCache(cache_dir)
+    load_all(cache)  # make sure every template has bytecode on disk
+    warm = load_all(cache)
+    return [(name, cold[name], warm[name]) for name in sorted(cold)]
+
+
+def _time_first_requests(app):
+    seen = set()
+    lock = threading.Lock()
+
+    @app.before_request
+    def start_first_request_timer():
+        if request.endpoint not in seen:
+            g._first_request_start = time.perf_counter()
+
+    @app.teardown_request
+    def report_first_request(exc=None):
+        start = g.pop('_first_request_start', None)
+        if start is None:
+            return
+        with lock:
+            if request.endpoint in seen:
+                return
+            seen.add(request.endpoint)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        state = 'warm' if app.config.get('TEMPLATES_WARMED') else 'cold'
+        print(f"[pid {os.getpid()}] First request to {request.endpoint}: {elapsed_ms:.1f} ms "
+              f"(templates {state})")
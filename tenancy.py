@@ -0,0 +1,106 @@
+"""Guild-based tenancy.
+
+Every pool belongs to the Discord guild it was created in, and every
+request works inside one guild: the allowed guild picked at login. Users
+who belong to several can switch guilds from the user menu. Pool queries
+are filtered to that guild, so predictions, ballots and stats of other
+guilds stay out of its queries.
+
+A guild can also be given its own database in the [Guilds] section
+(``<guild id> = sqlite:///guild_<id>.db``). Requests for that guild then
+use that database for everything (users, categories, pools and ballots),
+so busy guilds can be moved to separate storage. Guilds without an entry
+share SQLALCHEMY_DATABASE_URI.
+"""
+from contextlib import contextmanager
+
+from flask import current_app, flash, g, has_app_context, redirect, session, url_for
+
+from sessions import is_sessionless_request
+
+GUILD_KEY = 'guild_id'
+GUILDS_KEY = 'guilds'
+
+
+def guild_bind(guild_id):
+    return f'guild_{guild_id}'
+
+
+def init_tenancy(app, config):
+    """Register a bind per guild with its own database and track the request's guild"""
+    databases = {}
+    if config.has_section('Guilds'):
+        binds = app.config.setdefault('SQLALCHEMY_BINDS', {})
+        for guild_id in config.options('Guilds'):
+            binds[guild_bind(guild_id)] = config.get('Guilds', guild_id)
+            databases[guild_id] = guild_bind(guild_id)
+    app.extensions['guild_databases'] = databases
+
+    @app.before_request
+    def choose_guild():
+        if is_sessionless_request():
+            return None
+        g.guild_id = session.get(GUILD_KEY)
+        if 'discord_user' in session and g.guild_id not in session.get(GUILDS_KEY, {}):
+            # Signed in before guilds were tracked; don't let it see every guild
+            session.clear()
+            g.guild_id = None
+            flash('Please log in again.', 'error')
+            return redirect(url_for('login'))
+        return None
+
+    return databases
+
+
+def current_guild():
+    """The guild this request (or a use_guild() block, or manage_db --guild) works in"""
+    if not has_app_context():
+        return None
+    return g.get('guild_id') or current_app.config.get('GUILD_ID')
+
+
+def tenant_bind():
+    """Bind key of the current guild's own database, or None for the shared one"""
+    guild_id = current_guild()
+    if guild_id is None:
+        return None
+    return current_app.extensions.get('guild_databases', {}).get(guild_id)
+
+
+@contextmanager
+def use_guild(guild_id):
+    """Work in another guild inside the block (needs an app context)"""
+    previous = g.get('guild_id')
+    g.guild_id = guild_id
+    try:
+        yield
+    finally:
+        g.guild_id = previous
+
+
+def all_databases(app):
+    """None for the shared database plus each guild with its own, to visit every database once"""
+    return [None] + sorted(app.extensions.get('guild_databases', {}))
+
+
+def one_guild_per_database(guild_ids):
+    """Pick one of guild_ids for each distinct database they live in"""
+    databases = current_app.extensions.get('guild_databases', {})
+    own = sorted(guild_id for guild_id in guild_ids if guild_id in databases)
+    shared = sorted(guild_id for guild_id in guild_ids if guild_id not in databases)
+    return own + shared[:1]
+
+
+def select_guild(allowed_guilds):
+    """Remember the user's allowed guilds ({id: name}) and keep or pick the active one"""
+    session[GUILDS_KEY] = allowed_guilds
+    if session.get(GUILD_KEY) not in allowed_guilds:
+        session[GUILD_KEY] = sorted(allowed_guilds)[0]
+    g.guild_id = session[GUILD_KEY]
+    return session[GUILD_KEY]
+
+
+def create_tenant_schemas(db):
+    """Create the tables in every guild database (db.create_all only covers the shared one)"""
+    for bind_key in current_app.extensions.get('guild_databases', {}).values():
+        db.metadata.create_all(db.engines[bind_key])